@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+# Run every schedule.py and install.py command against fake ssh and Slurm
+# commands (fake_cluster.py), and report how long each took and how many
+# ssh connections and other processes it needed.
+
+import json
+import os
+from pathlib import Path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+usage = """
+Usage:
+bench.py [--repeat 3] [--ssh-latency 0.2] [--slurm-latency 0.1]
+         [--queue-wait "wjg=30,sfgf=5"] [--agent] [--only name,name]
+         [--save baseline.json] [--compare baseline.json] [--tolerance 0.25]
+         [--verbose]
+    Install into a fake Sherlock in a temporary directory, then time each
+    command (the median over --repeat fresh installs). ssh counts the
+    connections opened, spawns counts every ssh, Slurm and remote Python
+    process started.
+    With --agent, the commands run with schedule.py agent started.
+    --save writes the results to a file, and --compare fails (exit status 1)
+    if any command opens more connections or starts more processes than
+    in the saved results, or takes more than --tolerance longer.
+    --verbose prints the output of each command.
+"""
+
+repo_dir = Path(__file__).absolute().parent.parent
+fake_tools = ["ssh", "sbatch", "squeue", "scancel", "sacct", "scontrol", "python", "python3"]
+
+# (name, script and arguments, answers to prompts), run in this order.
+# Later commands rely on the state left behind by earlier ones.
+commands = [
+    ("install", ["install.py", "install"], "n\ny\ny\n"),
+    ("install-unchanged", ["install.py", "install"], "n\ny\nn\n"),
+    ("reset-password", ["install.py", "reset-password"], ""),
+    ("reset", ["schedule.py", "reset", "schedule.csv"], ""),
+    ("get", ["schedule.py", "get"], ""),
+    ("status", ["schedule.py", "status"], ""),
+    ("run-now", ["schedule.py", "run-now", "2", "1", "8"], ""),
+    ("extend", ["schedule.py", "extend", "1"], ""),
+    ("logs", ["schedule.py", "logs"], ""),
+    ("run-next", ["schedule.py", "run-next"], ""),
+    ("watch", ["schedule.py", "watch", "--once"], ""),
+    ("reset-presubmit", ["schedule.py", "reset", "--presubmit", "schedule.csv"], ""),
+    ("run-week", ["schedule.py", "run-week"], ""),
+    ("watch-week", ["schedule.py", "watch", "--once"], ""),
+    ("recommend", ["schedule.py", "recommend"], ""),
+    ("stats", ["schedule.py", "stats"], ""),
+]
+
+# Commands that need a notebook session running first
+needs_session = ["extend", "logs"]
+
+# Slack on the wall time check, in seconds, so very fast commands don't fail on noise
+wall_slack = 0.1
+
+def main():
+    if "-h" in sys.argv or "--help" in sys.argv:
+        print(usage)
+        sys.exit(1)
+    options = parse_options(sys.argv[1:], {
+        "repeat": 3,
+        "ssh-latency": 0.2,
+        "slurm-latency": 0.1,
+        "queue-wait": "wjg=30,sfgf=5",
+        "agent": False,
+        "only": None,
+        "save": None,
+        "compare": None,
+        "tolerance": 0.25,
+        "verbose": False,
+    })
+    selected = [c for c in commands
+                if options["only"] is None or c[0] in options["only"].split(",")]
+    settings = {k: options[k] for k in ["ssh-latency", "slurm-latency", "queue-wait", "agent"]}
+
+    runs = []
+    for i in range(options["repeat"]):
+        print("Run {} of {}...".format(i + 1, options["repeat"]), file=sys.stderr)
+        runs.append(run_once(settings, selected, options["verbose"]))
+    results = {}
+    for name, _, _ in selected:
+        results[name] = {
+            "wall": round(statistics.median(r[name]["wall"] for r in runs), 3),
+            "ssh": max(r[name]["ssh"] for r in runs),
+            "spawns": max(r[name]["spawns"] for r in runs),
+            "tools": runs[-1][name]["tools"],
+        }
+    print_results(results)
+
+    if options["save"] is not None:
+        json.dump({"settings": settings, "results": results},
+                  open(options["save"], "w"), indent=4, sort_keys=True)
+        print("Saved results to", options["save"])
+    if options["compare"] is not None:
+        baseline = json.load(open(options["compare"]))
+        if baseline["settings"] != settings:
+            print("Error: {} was measured with different settings: {}".format(
+                options["compare"], baseline["settings"]))
+            sys.exit(1)
+        regressions = compare(baseline["results"], results, options["tolerance"])
+        for line in regressions:
+            print("REGRESSION:", line)
+        if regressions:
+            sys.exit(1)
+        print("No regressions compared to", options["compare"])
+
+def parse_options(argv, defaults):
+    options = dict(defaults)
+    while argv:
+        name = argv[0][2:]
+        if not argv[0].startswith("--") or name not in defaults:
+            print("Error: unrecognized option {}".format(argv[0]))
+            print(usage)
+            sys.exit(1)
+        if defaults[name] is False:
+            options[name] = True
+            argv = argv[1:]
+            continue
+        if len(argv) < 2:
+            print("Error: {} needs a value".format(argv[0]))
+            sys.exit(1)
+        default_type = type(defaults[name]) if defaults[name] is not None else str
+        try:
+            options[name] = default_type(argv[1])
+        except ValueError:
+            print("Error: {} must be a {}".format(argv[0], default_type.__name__))
+            sys.exit(1)
+        argv = argv[2:]
+    return options
+
+def run_once(settings, selected, verbose):
+    """Install into a fresh fake cluster and run each command, returning their measurements"""
+    root = Path(tempfile.mkdtemp(prefix="notebook-bench-"))
+    try:
+        env = setup_sandbox(root, settings)
+        local = root / "laptop" / "notebook-scheduler"
+        calls = root / "cluster" / "calls.jsonl"
+        results = {}
+        agent_started = False
+        for name, args, answers in selected:
+            if settings["agent"] and not agent_started and not name.startswith("install"):
+                run_command(local, env, ["schedule.py", "agent", "--start"], "", verbose)
+                agent_started = True
+            if name in needs_session:
+                start_job(root, env)
+            calls.write_text("")
+            start = time.time()
+            run_command(local, env, args, answers, verbose)
+            wall = time.time() - start
+            tools = {}
+            for line in calls.read_text().splitlines():
+                tool = json.loads(line)["tool"]
+                tools[tool] = tools.get(tool, 0) + 1
+            results[name] = {
+                "wall": wall,
+                "ssh": tools.get("ssh", 0),
+                "spawns": sum(tools.values()),
+                "tools": tools,
+            }
+        if agent_started:
+            run_command(local, env, ["schedule.py", "agent", "--stop"], "", verbose)
+        return results
+    finally:
+        shutil.rmtree(str(root), ignore_errors=True)
+
+def setup_sandbox(root, settings):
+    """Set up a laptop with a copy of the repo and a fake cluster under root.
+
+    Returns the environment to run commands with.
+    """
+    cluster = root / "cluster"
+    bin_dir = root / "bin"
+    laptop = root / "laptop"
+    local = laptop / "notebook-scheduler"
+    for d in [cluster / "hosts" / "sherlock", bin_dir, local]:
+        d.mkdir(parents=True)
+    (cluster / "calls.jsonl").write_text("")
+
+    # Wrappers for each fake tool, ahead of the real ones on the PATH
+    for tool in fake_tools:
+        wrapper = bin_dir / tool
+        wrapper.write_text("#!/bin/sh\nexec '{}' '{}' {} \"$@\"\n".format(
+            sys.executable, repo_dir / "bench" / "fake_cluster.py", tool))
+        wrapper.chmod(0o755)
+
+    for path in repo_dir.iterdir():
+        if path.is_file() and path.suffix in [".py", ".sbatch", ".sh", ".conf", ".csv"]:
+            shutil.copy(str(path), str(local / path.name))
+    shutil.copy(str(repo_dir / "example_schedule.csv"), str(local / "schedule.csv"))
+    config = {
+        "SHERLOCK_USER": "benchuser",
+        "INSTALL_PATH": str(cluster / "hosts" / "sherlock" / "notebook-scheduler"),
+        "PARTITION": "wjg,sfgf",
+        "JUPYTER_PORT": 50001,
+        "R_PORT": 50002,
+        "CODE_SERVER_PORT": 50003,
+    }
+    json.dump(config, open(str(local / "config.json"), "w"), indent=4, sort_keys=True)
+
+    env = dict(os.environ)
+    env.update({
+        "PATH": str(bin_dir) + os.pathsep + env.get("PATH", ""),
+        "HOME": str(laptop),
+        "SHELL": "/bin/bash",
+        "FAKE_CLUSTER_DIR": str(cluster),
+        "FAKE_SSH_LATENCY": str(settings["ssh-latency"]),
+        "FAKE_SLURM_LATENCY": str(settings["slurm-latency"]),
+        "FAKE_QUEUE_WAIT": settings["queue-wait"],
+        "FAKE_PYTHON": sys.executable,
+    })
+    return env
+
+def start_job(root, env):
+    """Start the newest notebook job on the fake cluster, as if its time had come"""
+    subprocess.run(
+        [sys.executable, str(repo_dir / "bench" / "fake_cluster.py"), "start-job", "sherlock",
+         str(root / "cluster" / "hosts" / "sherlock" / "notebook-scheduler")],
+        env=env, check=True)
+
+def run_command(cwd, env, args, answers, verbose):
+    p = subprocess.run(
+        [sys.executable, str(cwd / args[0])] + args[1:],
+        input=answers.encode(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        cwd=str(cwd), env=env)
+    if verbose or p.returncode != 0:
+        print("$ " + " ".join(args))
+        print(p.stdout.decode())
+    if p.returncode != 0:
+        print("Error: {} exited with status {}".format(" ".join(args), p.returncode))
+        sys.exit(1)
+
+def print_results(results):
+    print("{:18} {:>8} {:>5} {:>7}  {}".format("command", "wall (s)", "ssh", "spawns", "by tool"))
+    for name, r in results.items():
+        print("{:18} {:8.2f} {:5} {:7}  {}".format(
+            name, r["wall"], r["ssh"], r["spawns"],
+            " ".join("{}={}".format(k, v) for k, v in sorted(r["tools"].items()))))
+
+def compare(baseline, results, tolerance):
+    regressions = []
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        b = baseline[name]
+        for key in ["ssh", "spawns"]:
+            if r[key] > b[key]:
+                regressions.append("{}: {} went from {} to {}".format(name, key, b[key], r[key]))
+        if r["wall"] > b["wall"] * (1 + tolerance) + wall_slack:
+            regressions.append("{}: wall time went from {:.2f}s to {:.2f}s".format(
+                name, b["wall"], r["wall"]))
+    return regressions
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+
+# Stand-ins for ssh and the Slurm commands, so schedule.py and install.py
+# can run end to end without Sherlock (see bench.py, which sets them up).
+# fake_cluster.py ssh [options] host command -- run command in the host's fake home
+# fake_cluster.py sbatch|squeue|scancel|sacct|scontrol [args] -- fake Slurm on the current host
+# fake_cluster.py python|python3 [args] -- count a Python start, then run Python
+# fake_cluster.py start-job host install_dir -- start the host's newest notebook job now
+#
+# Settings come from environment variables:
+#   FAKE_CLUSTER_DIR     state directory (required). Each host gets a home
+#                        directory in hosts/<host>, and every call is logged
+#                        to calls.jsonl
+#   FAKE_SSH_LATENCY     seconds added to each ssh connection (default 0.2)
+#   FAKE_SLURM_LATENCY   seconds added to each Slurm command (default 0.1)
+#   FAKE_QUEUE_WAIT      minutes a job waits in each partition, e.g.
+#                        "wjg=30,sfgf=5". A partition of * matches any name,
+#                        other partitions are rejected (default "*=10")
+#   FAKE_PYTHON          Python interpreter to run for python/python3
+#   FAKE_SCONTROL_DENY   if set, scontrol update fails as it does for users
+#                        who aren't allowed to raise time limits
+
+import fcntl
+import json
+import os
+from pathlib import Path
+import random
+import subprocess
+import sys
+import time
+
+state_dir = Path(os.environ["FAKE_CLUSTER_DIR"])
+ssh_latency = float(os.environ.get("FAKE_SSH_LATENCY", 0.2))
+slurm_latency = float(os.environ.get("FAKE_SLURM_LATENCY", 0.1))
+
+# Finished notebook jobs that sacct reports, per week of history
+sacct_slots = [(0, 9, 0, 1, 16), (1, 12, 30, 2, 8)] # (weekday, hour, minute, cpus, mem_gb)
+sacct_weeks = 12
+
+def main():
+    tool = sys.argv[1]
+    args = sys.argv[2:]
+    log_call(tool, args)
+    if tool == "ssh":
+        fake_ssh(args)
+    elif tool in ["python", "python3"]:
+        python = os.environ.get("FAKE_PYTHON", sys.executable)
+        os.execv(python, [python] + args)
+    elif tool in slurm_tools:
+        time.sleep(slurm_latency)
+        with queue_lock():
+            sys.exit(slurm_tools[tool](args))
+    elif tool == "start-job":
+        os.environ["FAKE_CLUSTER_HOST"] = args[0]
+        with queue_lock():
+            sys.exit(start_job(Path(args[1])))
+    else:
+        print("fake_cluster.py: unknown tool " + tool, file=sys.stderr)
+        sys.exit(2)
+
+def log_call(tool, args):
+    record = {"tool": tool, "host": os.environ.get("FAKE_CLUSTER_HOST"),
+              "args": args, "time": time.time()}
+    with open(str(state_dir / "calls.jsonl"), "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+## ssh
+
+# Options that take a value, as in ssh(1)
+ssh_value_options = set("BbcDEeFIiJLlmOopQRSWw")
+
+def fake_ssh(args):
+    # Options may come before or after the host, the command starts after both
+    host = None
+    command = []
+    while args:
+        arg = args.pop(0)
+        if command or (host is not None and not arg.startswith("-")):
+            command.append(arg)
+        elif arg.startswith("-") and len(arg) > 1:
+            if arg[-1] in ssh_value_options and len(arg) == 2:
+                args.pop(0)
+        else:
+            host = arg
+    if host is None or not command:
+        print("fake ssh: expected a host and a command", file=sys.stderr)
+        sys.exit(255)
+    time.sleep(ssh_latency)
+
+    home = host_home(host)
+    env = dict(os.environ)
+    env.update({"HOME": str(home), "USER": "benchuser",
+                "FAKE_CLUSTER_HOST": host})
+    sys.exit(subprocess.run(["bash", "-c", " ".join(command)], cwd=str(home),
+                            env=env).returncode)
+
+def host_home(host):
+    home = state_dir / "hosts" / host
+    if not home.is_dir():
+        home.mkdir(parents=True)
+    return home
+
+## Slurm
+
+def queue_file():
+    return host_home(os.environ.get("FAKE_CLUSTER_HOST", "sherlock")) / ".fake-slurm.json"
+
+class queue_lock:
+    def __enter__(self):
+        self.file = open(str(queue_file()) + ".lock", "w")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+    def __exit__(self, *exc):
+        self.file.close()
+
+def read_queue():
+    if not queue_file().exists():
+        return {"next_id": 1000, "jobs": []}
+    return json.loads(queue_file().read_text())
+
+def write_queue(queue):
+    queue_file().write_text(json.dumps(queue, indent=1))
+
+def queue_waits():
+    waits = {}
+    for item in os.environ.get("FAKE_QUEUE_WAIT", "*=10").split(","):
+        name, minutes = item.split("=")
+        waits[name.strip()] = float(minutes) * 60
+    return waits
+
+def queue_wait(partition, cpus, mem_gb):
+    """Seconds a job waits to start, or None if the partition doesn't exist"""
+    waits = queue_waits()
+    base = waits.get(partition, waits.get("*"))
+    if base is None:
+        return None
+    # Bigger jobs wait longer
+    return base * max(1, cpus / 4, mem_gb / 32)
+
+def parse_args(args, short_names):
+    """Split Slurm-style arguments into ({option: value}, positional args)"""
+    options = {}
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--"):
+            if "=" in arg:
+                name, value = arg[2:].split("=", 1)
+            elif args and not args[0].startswith("-") and arg[2:] not in flag_options:
+                name, value = arg[2:], args.pop(0)
+            else:
+                name, value = arg[2:], True
+            options[name] = value
+        elif arg.startswith("-") and len(arg) > 1:
+            name = short_names.get(arg[1], arg[1])
+            if name in flag_options:
+                options[name] = True
+            else:
+                options[name] = arg[2:] or args.pop(0)
+        else:
+            positional.append(arg)
+    return options, positional
+
+flag_options = ["test-only", "parsable", "noheader", "parsable2", "allocations", "start"]
+
+def parse_time(text, now):
+    if text in ["now", "", None]:
+        return now
+    if text.startswith("now+"):
+        units = {"seconds": 1, "minutes": 60, "hours": 3600, "days": 86400}
+        amount = text[4:].rstrip("abcdefghijklmnopqrstuvwxyz")
+        unit = text[4 + len(amount):] or "seconds"
+        return now + float(amount) * units.get(unit, 1)
+    for fmt in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M"]:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise ValueError("invalid time " + text)
+
+def parse_limit(text):
+    """Seconds in a Slurm time limit: minutes, H:MM:SS or D-H:MM:SS"""
+    days = 0
+    if "-" in text:
+        days, text = text.split("-")
+    parts = [int(p) for p in text.split(":")]
+    if len(parts) == 1:
+        return int(days) * 86400 + parts[0] * 60
+    while len(parts) < 3:
+        parts.append(0)
+    return int(days) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+def format_time(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t))
+
+def format_duration(seconds):
+    seconds = int(max(0, seconds))
+    days, seconds = divmod(seconds, 86400)
+    text = "{:02}:{:02}:{:02}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "{}-{}".format(days, text) if days else text
+
+sbatch_short = {"J": "job-name", "p": "partition", "t": "time", "c": "cpus-per-task",
+                "b": "begin", "o": "output", "e": "error"}
+
+def sbatch(args):
+    options, positional = parse_args(list(args), sbatch_short)
+    if not positional:
+        print("sbatch: error: no batch script given", file=sys.stderr)
+        return 1
+    # Command line options override #SBATCH lines in the script
+    script_options = {}
+    for line in open(positional[0]):
+        if line.startswith("#SBATCH "):
+            script_options.update(parse_args(line.split()[1:], sbatch_short)[0])
+    script_options.update(options)
+    options = script_options
+
+    now = time.time()
+    cpus = int(options.get("cpus-per-task", 1))
+    mem_gb = float(str(options.get("mem", "4G")).rstrip("G"))
+    # Like Slurm, a list of partitions goes to the one that can start the job first
+    choices = []
+    for partition in str(options.get("partition", "normal")).split(","):
+        wait = queue_wait(partition, cpus, mem_gb)
+        if wait is not None:
+            choices.append((wait, partition))
+    if not choices:
+        print("sbatch: error: Batch job submission failed: "
+              "Invalid partition name specified", file=sys.stderr)
+        return 1
+    wait, partition = min(choices)
+    begin = max(now, parse_time(options.get("begin"), now))
+
+    queue = read_queue()
+    job_id = queue["next_id"]
+    if "test-only" in options:
+        print("sbatch: Job {} to start at {} using {} processors on nodes sh01-01n01 "
+              "in partition {}".format(job_id, format_time(begin + wait), cpus, partition),
+              file=sys.stderr)
+        return 0
+    queue["next_id"] += 1
+    queue["jobs"].append({
+        "id": str(job_id),
+        "name": options.get("job-name", Path(positional[0]).name),
+        "partition": partition,
+        "cpus": cpus,
+        "mem_gb": mem_gb,
+        "submit": now,
+        "eligible": begin,
+        "start": begin + wait,
+        "limit": parse_limit(str(options.get("time", "60"))),
+    })
+    write_queue(queue)
+    if "parsable" in options:
+        print(job_id)
+    else:
+        print("Submitted batch job {}".format(job_id))
+    return 0
+
+def live_jobs(queue, now):
+    """Jobs still pending or running, with their current state"""
+    jobs = []
+    for job in queue["jobs"]:
+        if now >= job["start"] + job["limit"]:
+            continue
+        job = dict(job)
+        job["state"] = "R" if now >= job["start"] else "PD"
+        jobs.append(job)
+    return jobs
+
+squeue_fields = {
+    "i": lambda j, now: j["id"],
+    "j": lambda j, now: j["name"],
+    "t": lambda j, now: j["state"],
+    "T": lambda j, now: {"R": "RUNNING", "PD": "PENDING"}[j["state"]],
+    "P": lambda j, now: j["partition"],
+    "C": lambda j, now: str(j["cpus"]),
+    "m": lambda j, now: "{:g}G".format(j["mem_gb"]),
+    "S": lambda j, now: format_time(j["start"]),
+    "M": lambda j, now: format_duration(now - j["start"]) if j["state"] == "R" else "0:00",
+    "l": lambda j, now: format_duration(j["limit"]),
+    "L": lambda j, now: format_duration(j["start"] + j["limit"] - max(now, j["start"])),
+    "N": lambda j, now: "sh01-01n01" if j["state"] == "R" else "",
+    "r": lambda j, now: "None" if j["state"] == "R" else "BeginTime",
+    # Earlier submissions get higher priority
+    "Q": lambda j, now: str(int(2e9 - j["submit"])),
+}
+
+def squeue(args):
+    options, positional = parse_args(list(args), {
+        "u": "user", "n": "name", "h": "noheader", "o": "format", "t": "states",
+        "j": "jobs", "p": "partition"})
+    now = time.time()
+    jobs = live_jobs(read_queue(), now)
+    if "name" in options:
+        jobs = [j for j in jobs if j["name"] in options["name"].split(",")]
+    if "states" in options:
+        states = [{"PENDING": "PD", "RUNNING": "R"}.get(s, s)
+                  for s in options["states"].upper().split(",")]
+        jobs = [j for j in jobs if j["state"] in states]
+    if "jobs" in options:
+        jobs = [j for j in jobs if j["id"] in options["jobs"].split(",")]
+    if "partition" in options:
+        jobs = [j for j in jobs if j["partition"] in options["partition"].split(",")]
+    if "start" in options:
+        jobs = [j for j in jobs if j["state"] == "PD"]
+    fmt = options.get("format", "%.18i %.9P %.8j %.2t %.10M %.6D %R")
+
+    if "noheader" not in options:
+        print(format_squeue_line(fmt, lambda code: code.upper()))
+    for job in jobs:
+        print(format_squeue_line(
+            fmt, lambda code: squeue_fields.get(code, lambda j, now: "")(job, now)))
+    return 0
+
+def format_squeue_line(fmt, value):
+    out = ""
+    i = 0
+    while i < len(fmt):
+        if fmt[i] != "%":
+            out += fmt[i]
+            i += 1
+            continue
+        # Skip field widths such as %.18i
+        i += 1
+        while i < len(fmt) and fmt[i] in ".0123456789":
+            i += 1
+        if i < len(fmt):
+            out += value(fmt[i])
+            i += 1
+    return out
+
+def scancel(args):
+    ids = set(a for a in args if not a.startswith("-"))
+    queue = read_queue()
+    queue["jobs"] = [j for j in queue["jobs"] if j["id"] not in ids]
+    write_queue(queue)
+    return 0
+
+def sacct_jobs(now):
+    """Synthetic history of notebook jobs, plus finished jobs from the fake queue"""
+    rng = random.Random(0)
+    jobs = []
+    today = time.localtime(now)
+    midnight = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, 0, 0, 0, 0, 0, -1))
+    week_start = midnight - today.tm_wday * 86400
+    for week in range(1, sacct_weeks + 1):
+        for weekday, hour, minute, cpus, mem_gb in sacct_slots:
+            eligible = week_start - week * 7 * 86400 + weekday * 86400 + \
+                hour * 3600 + minute * 60
+            start = eligible + rng.uniform(0, 1800)
+            elapsed = rng.uniform(1800, 4 * 3600)
+            jobs.append({
+                "id": str(900 - len(jobs)), "name": "notebook", "partition": "wjg",
+                "cpus": cpus, "mem_gb": mem_gb, "submit": eligible - 86400,
+                "eligible": eligible, "start": start, "end": start + elapsed,
+                "limit": 4 * 3600 + 600, "state": "COMPLETED",
+                "total_cpu": elapsed * cpus * rng.uniform(0.05, 0.6),
+                "max_rss_gb": mem_gb * rng.uniform(0.1, 0.7),
+            })
+    for job in read_queue()["jobs"]:
+        if job["start"] > now:
+            continue
+        job = dict(job, end=min(now, job["start"] + job["limit"]))
+        job["state"] = "RUNNING" if job["end"] == now else "TIMEOUT"
+        job["total_cpu"] = (job["end"] - job["start"]) * 0.1
+        job["max_rss_gb"] = 1
+        jobs.append(job)
+    return jobs
+
+sacct_fields = {
+    "JobID": lambda j: j["id"],
+    "JobName": lambda j: j["name"],
+    "Submit": lambda j: format_time(j["submit"]),
+    "Eligible": lambda j: format_time(j["eligible"]),
+    "Start": lambda j: format_time(j["start"]),
+    "End": lambda j: "Unknown" if j["state"] == "RUNNING" else format_time(j["end"]),
+    "Elapsed": lambda j: format_duration(j["end"] - j["start"]),
+    "TotalCPU": lambda j: format_duration(j["total_cpu"]),
+    "MaxRSS": lambda j: "",
+    "State": lambda j: j["state"],
+    "Partition": lambda j: j["partition"],
+    "AllocCPUS": lambda j: str(j["cpus"]),
+    "ReqMem": lambda j: "{:g}G".format(j["mem_gb"]),
+    "Timelimit": lambda j: format_duration(j["limit"]),
+}
+
+def sacct(args):
+    options, positional = parse_args(list(args), {
+        "u": "user", "S": "starttime", "o": "format", "X": "allocations",
+        "n": "noheader", "P": "parsable2"})
+    now = time.time()
+    since = options.get("starttime", "now-1days")
+    if since.startswith("now-"):
+        amount = since[4:].rstrip("abcdefghijklmnopqrstuvwxyz")
+        unit = since[4 + len(amount):]
+        since = now - float(amount) * {"days": 86400, "weeks": 7 * 86400,
+                                       "hours": 3600}.get(unit, 1)
+    else:
+        since = parse_time(since, now)
+    fields = options.get("format", "JobID,JobName,Partition,AllocCPUS,State").split(",")
+    separator = "|" if "parsable2" in options else " "
+
+    rows = []
+    if "noheader" not in options:
+        rows.append(fields)
+    for job in sacct_jobs(now):
+        if job["end"] < since or job["name"] not in options.get("name", job["name"]).split(","):
+            continue
+        rows.append([sacct_fields.get(f, lambda j: "")(job) for f in fields])
+        if "allocations" in options:
+            continue
+        # Steps: memory use is reported on the batch step
+        for step in ["batch", "extern"]:
+            step_job = dict(job, id=job["id"] + "." + step)
+            row = [sacct_fields.get(f, lambda j: "")(step_job) for f in fields]
+            if "MaxRSS" in fields and step == "batch":
+                row[fields.index("MaxRSS")] = "{}K".format(int(job["max_rss_gb"] * 1024**2))
+            rows.append(row)
+    for row in rows:
+        print(separator.join(row))
+    return 0
+
+def scontrol(args):
+    # Only scontrol update JobId=id TimeLimit=[+]limit
+    settings = dict(a.split("=", 1) for a in args[1:] if "=" in a)
+    if args[:1] != ["update"] or "JobId" not in settings or "TimeLimit" not in settings:
+        print("scontrol: error: unsupported command", file=sys.stderr)
+        return 1
+    if os.environ.get("FAKE_SCONTROL_DENY"):
+        print("slurm_update error: Access/permission denied", file=sys.stderr)
+        return 1
+    queue = read_queue()
+    for job in queue["jobs"]:
+        if job["id"] == settings["JobId"]:
+            limit = settings["TimeLimit"]
+            if limit.startswith("+"):
+                job["limit"] += parse_limit(limit[1:])
+            else:
+                job["limit"] = parse_limit(limit)
+            write_queue(queue)
+            return 0
+    print("slurm_update error: Invalid job id specified", file=sys.stderr)
+    return 1
+
+def start_job(install_dir):
+    """Start the newest notebook job now, and leave behind the session files and
+    logs its script would write (fake sbatch doesn't run job scripts)"""
+    queue = read_queue()
+    jobs = [j for j in queue["jobs"] if j["name"] == "notebook"]
+    if not jobs:
+        print("fake_cluster.py: no notebook job to start", file=sys.stderr)
+        return 1
+    job = jobs[-1]
+    job["start"] = time.time()
+    write_queue(queue)
+    (install_dir / "current-job").write_text(job["id"] + "\n")
+    (install_dir / "current-host").write_text("sh01-01n01\n")
+    (install_dir / "current-ports").write_text("50002 50001 50003\n")
+    log_dir = install_dir / "logs" / job["id"]
+    log_dir.mkdir(parents=True, exist_ok=True)
+    (log_dir / "notebook.out").write_text(
+        "".join("Starting servers, line {}\n".format(i) for i in range(200)))
+    (log_dir / "notebook.err").write_text("")
+    return 0
+
+slurm_tools = {
+    "sbatch": sbatch,
+    "squeue": squeue,
+    "scancel": scancel,
+    "sacct": sacct,
+    "scontrol": scontrol,
+}
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# History of submitted notebook jobs, kept in history.sqlite in the installation
+# directory on Sherlock. Filled in when schedule.py submits a job, from the
+# service ready times logged by notebook jobs, and from bulk sacct imports.
+
+import json
+import math
+import os
+import sqlite3
+import subprocess
+import time
+
+import tracing
+
+db_file = "history.sqlite"
+
+# Readiness records appended by notebook_helper.py ready, one JSON object per line
+ready_file = "ready_history.jsonl"
+
+# Re-import jobs that were eligible this long before the last import, since
+# they may have started or finished since then
+import_overlap_days = 7
+first_import_days = 60
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    source TEXT,
+    submitted REAL,
+    scheduled_start REAL,
+    eligible REAL,
+    start REAL,
+    end REAL,
+    state TEXT,
+    partition TEXT,
+    cpus INTEGER,
+    mem_gb REAL,
+    hours REAL,
+    ready_seconds REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def connect():
+    db = sqlite3.connect(db_file, timeout=30)
+    db.executescript(schema)
+    return db
+
+def record_submission(job_id, source, scheduled_start, partition, cpus, mem_gb, hours):
+    """Record a job as schedule.py submits it. Times are unix times (or None)"""
+    db = connect()
+    with db:
+        db.execute("INSERT OR IGNORE INTO jobs (job_id) VALUES (?)", (job_id,))
+        db.execute(
+            "UPDATE jobs SET source=?, submitted=?, scheduled_start=?, partition=?, "
+            "cpus=?, mem_gb=?, hours=? WHERE job_id=?",
+            (source, time.time(), scheduled_start, partition, cpus, mem_gb, hours, job_id))
+    db.close()
+
+def import_if_stale(max_age):
+    """Import from sacct and the ready log if the last import was over max_age seconds ago"""
+    db = connect()
+    row = db.execute("SELECT value FROM meta WHERE key='last_import'").fetchone()
+    db.close()
+    if row is None or time.time() - float(row[0]) > max_age:
+        import_all()
+
+def import_all():
+    db = connect()
+    row = db.execute("SELECT value FROM meta WHERE key='last_import'").fetchone()
+    if row is None:
+        since = time.time() - first_import_days * 86400
+    else:
+        since = float(row[0]) - import_overlap_days * 86400
+    now = time.time()
+    with db:
+        import_sacct(db, since)
+        import_ready_times(db)
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_import', ?)",
+                   (str(now),))
+    db.close()
+
+def import_sacct(db, since):
+    command = [
+        "sacct",
+        "--user", os.environ.get("USER", ""),
+        "--name", "notebook",
+        "--allocations",
+        "--starttime", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(since)),
+        "--noheader", "--parsable2",
+        "--format", "JobID,Submit,Eligible,Start,End,State,Partition,AllocCPUS,ReqMem,Timelimit"]
+    output = tracing.run(command, stdout=subprocess.PIPE, check=True).stdout.decode()
+    for line in output.splitlines():
+        job_id, submit, eligible, start, end, state, partition, cpus, req_mem, limit = \
+            line.split("|")
+        limit_seconds = parse_optional(parse_duration, limit)
+        db.execute("INSERT OR IGNORE INTO jobs (job_id, source) VALUES (?, 'sacct')",
+                   (job_id,))
+        db.execute(
+            "UPDATE jobs SET submitted=COALESCE(submitted, ?), eligible=?, start=?, end=?, "
+            "state=?, partition=?, cpus=?, mem_gb=COALESCE(?, mem_gb), "
+            "hours=COALESCE(hours, ?) WHERE job_id=?",
+            (parse_time(submit), parse_time(eligible), parse_time(start), parse_time(end),
+             state.split()[0] if state else None, partition, int(cpus or 0),
+             parse_optional(parse_memory_gb, req_mem),
+             None if limit_seconds is None else limit_seconds / 3600, job_id))
+
+def import_ready_times(db):
+    if not os.path.exists(ready_file):
+        return
+    for line in open(ready_file):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("job_id") is None or record.get("seconds") is None:
+            continue
+        db.execute("INSERT OR IGNORE INTO jobs (job_id) VALUES (?)", (record["job_id"],))
+        db.execute("UPDATE jobs SET ready_seconds=? WHERE job_id=?",
+                   (record["seconds"], record["job_id"]))
+
+def parse_time(text):
+    """Unix time of a Slurm timestamp, or None for Unknown, None, etc."""
+    try:
+        return time.mktime(time.strptime(text, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+def parse_duration(duration):
+    """Seconds in a Slurm duration such as 1-02:03:04, 02:03:04 or 03:04.567"""
+    days = 0
+    if "-" in duration:
+        days, duration = duration.split("-")
+    parts = [float(p) for p in duration.split(":") if p]
+    seconds = 0
+    for p in parts:
+        seconds = seconds * 60 + p
+    return int(days) * 86400 + seconds
+
+def parse_memory_gb(memory):
+    """GB in a Slurm memory amount such as 1234K, 1.5G or 16Gn (blank is 0)"""
+    # Older Slurm adds n or c for per node or per cpu
+    memory = memory.rstrip("nc")
+    units = {"K": 1 / 1024**2, "M": 1 / 1024, "G": 1, "T": 1024}
+    if memory == "":
+        return 0
+    if memory[-1] in units:
+        return float(memory[:-1]) * units[memory[-1]]
+    return float(memory) / 1024**3
+
+def parse_optional(parse, text):
+    """parse(text), or None if text is blank or not understood (e.g. UNLIMITED)"""
+    try:
+        return parse(text) if text.strip() else None
+    except (ValueError, IndexError):
+        return None
+
+# Fewest past jobs to estimate a lead time from
+min_lead_jobs = 5
+
+def lead_time(partitions, cpus, mem_gb, q, since):
+    """Seconds from becoming eligible to having its servers ready that q% of
+    past jobs like this one took, or None if there isn't enough history.
+
+    Uses jobs that started after since in the given partitions with the same
+    cpus and memory if there are enough, otherwise any size in those
+    partitions, otherwise any job.
+    """
+    jobs = [j for j in finished_jobs(since)
+            if j["eligible"] is not None and j["ready_seconds"] is not None]
+    in_partitions = [j for j in jobs if j["partition"] in partitions]
+    same_shape = [j for j in in_partitions
+                  if j["cpus"] == cpus and j["mem_gb"] is not None
+                  and abs(j["mem_gb"] - mem_gb) < 0.5]
+    for group in [same_shape, in_partitions, jobs]:
+        if len(group) >= min_lead_jobs:
+            return percentile(
+                [j["start"] - j["eligible"] + j["ready_seconds"] for j in group], q)
+    return None
+
+def scheduled_starts():
+    """Scheduled start (a unix time) of each job submitted for a schedule entry, by job id"""
+    db = connect()
+    rows = db.execute(
+        "SELECT job_id, scheduled_start FROM jobs WHERE scheduled_start IS NOT NULL").fetchall()
+    db.close()
+    return dict(rows)
+
+def finished_jobs(since):
+    """Jobs that started after since (a unix time), as dicts"""
+    db = connect()
+    db.row_factory = sqlite3.Row
+    rows = db.execute(
+        "SELECT * FROM jobs WHERE start IS NOT NULL AND start >= ? ORDER BY start",
+        (since,)).fetchall()
+    db.close()
+    return [dict(r) for r in rows]
+
+def percentile(values, q):
+    """Nearest-rank q-th percentile of a non-empty list"""
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
@@ -5,16 +5,22 @@
 
 import csv
 import datetime
+import hashlib
+import io
 import json
 import os
 from pathlib import Path
+import posixpath
 import random
+import shlex
 import string
 import subprocess
 import sys
-import tempfile
+import tarfile
 import time
 
+import tracing
+
 if sys.version_info < (3, 5):
     print("Error: Python version 3.5 or greater is required")
     sys.exit(1)
@@ -24,8 +30,14 @@ Usage:
 install.py --help
     Show this help.
 
-install.py install 
-    Set up a fresh installation on Sherlock.
+Either command can be given --trace to save how long each step took
+to trace.json (see schedule.py --help).
+
+install.py install [--refresh]
+    Set up a fresh installation on Sherlock, or update an existing one.
+    Only files that changed since the last install are copied, and the
+    R_LIBS_USER found by the last install is reused. --refresh copies
+    every file and checks R_LIBS_USER again.
     (Run the command on your local computer)
 
 install.py reset-password
@@ -33,30 +45,49 @@ install.py reset-password
     (Run the command on your local computer)
 """
 
+# Files copied into the installation directory on Sherlock
+install_files = ["schedule.py", "install.py", "set_jupyter_password.py",
+                 "notebook_helper.py", "history.py", "tracing.py", "config.json",
+                 "notebook.template.sbatch",
+                 "rserver_auth.sh", "rsession.template.conf"]
+
+# Hashes of the files copied by the last install, kept in the installation directory
+install_manifest = "install_manifest.json"
+
+# R_LIBS_USER as found by the last install, kept in the installation directory
+r_libs_file = "r_libs_user.txt"
+
+# Number of ssh sessions opened to Sherlock so far
+ssh_round_trips = 0
+
 def main():
     if on_sherlock():
         print("Error: run install.py from your local computer, not on Sherlock")
         sys.exit(0)
+    tracing.start(sys.argv)
     install_dir = str(Path(__file__).parent)
     os.chdir(install_dir)
 
-    if len(sys.argv) != 2 or "-h" in sys.argv or "--help" in sys.argv:
+    if len(sys.argv) < 2 or "-h" in sys.argv or "--help" in sys.argv:
         print(usage)
         sys.exit(1)
-    if sys.argv[1] not in ["install", "reset-password"]:
+    if sys.argv[1:] not in [["install"], ["install", "--refresh"], ["reset-password"]]:
         print(usage)
         sys.exit(1)
 
     command = sys.argv[1]
     if command == "install":
-        cmd_install()
+        cmd_install(refresh="--refresh" in sys.argv)
     elif command == "reset-password":
         cmd_password()
 
 def on_sherlock():
-    return "SHERLOCK" in os.environ
+    """Whether this is an installation on a cluster rather than the copy on a
+    local computer: install marks the config.json it copies with REMOTE"""
+    config_file = Path(__file__).parent / "config.json"
+    return config_file.is_file() and json.load(open(str(config_file))).get("REMOTE", False)
 
-def cmd_install():
+def cmd_install(refresh):
     # 1. Get user input
     config_exists = os.path.isfile("config.json")
     if config_exists:
@@ -102,146 +133,303 @@ def cmd_install():
     json.dump(config , open("config.json", "w"), indent=4, sort_keys=True)
     
     username = config["SHERLOCK_USER"]
-    install_dir = config["INSTALL_PATH"]
-    rstudio_port = config["R_PORT"]
-    jupyter_port = config["JUPYTER_PORT"]
-    code_server_port = config["CODE_SERVER_PORT"]
-    print("Your RStudio port number is:", rstudio_port)
-    print("Your Jupyter port number is:", jupyter_port)
-    print("Your Code server port number is:", code_server_port)
+    clusters = cluster_configs(config)
+    for name, cluster in sorted(clusters.items()):
+        if len(clusters) > 1:
+            print("\nCluster {} (ssh {}, installed in {}):".format(
+                name, cluster["HOST"], cluster["INSTALL_PATH"]))
+        print("Your RStudio port number is:", cluster["R_PORT"])
+        print("Your Jupyter port number is:", cluster["JUPYTER_PORT"])
+        print("Your Code server port number is:", cluster["CODE_SERVER_PORT"])
 
     # 4. Get user to set up SSH config
     if yes_or_no("Set up files for ssh proxying in your ~/.ssh folder now? "):
-        ssh_config_entry = ssh_config.format(username=username)
-        ssh_config_path = (Path.home() / ".ssh/config")
-        if not ssh_config_path.exists() or \
-            ssh_config_entry not in ssh_config_path.read_text():
-            print("\nCopy the following text to the file ~/.ssh/config:\n")
-            print(ssh_config_entry)
-            input("\nPress enter once you have copied over the above text")
+        hosts = sorted(set(c["HOST"] for c in clusters.values()))
+        if "sherlock" in hosts:
+            ssh_config_entry = ssh_config.format(username=username)
+            ssh_config_path = (Path.home() / ".ssh/config")
+            if not ssh_config_path.exists() or \
+                ssh_config_entry not in ssh_config_path.read_text():
+                print("\nCopy the following text to the file ~/.ssh/config:\n")
+                print(ssh_config_entry)
+                input("\nPress enter once you have copied over the above text")
+        for host in hosts:
+            if host != "sherlock":
+                print("Make sure ~/.ssh/config has an entry for {} like the one for sherlock, "
+                      "so `ssh {}` connects without a password prompt".format(host, host))
 
         print("Testing ssh connection...\n")
-        if not ssh_works():
-            print("\nError connecting via 'ssh sherlock', exiting now")
-            sys.exit(1)
-
-        print("Copying script to ~/.ssh/connect-nb.sh")
-        (Path.home() / ".ssh/connect-nb.sh")\
-            .write_text(connect_script.format(
-                install_dir=install_dir, 
-                jupyter_port=jupyter_port, 
-                rstudio_port=rstudio_port,
-                code_server_port=code_server_port,
-            ))
-        alias_text = "alias \"nb=bash $HOME/.ssh/connect-nb.sh\""
+        installed = read_all_installed(clusters)
+
+        alias_lines = []
+        for name, cluster in sorted(clusters.items()):
+            script_name, alias, cache_name = connect_script_names(name, config)
+            print("Copying script to ~/.ssh/" + script_name)
+            (Path.home() / ".ssh" / script_name)\
+                .write_text(connect_script.format(
+                    host=cluster["HOST"],
+                    cache_name=cache_name,
+                    install_dir=cluster["INSTALL_PATH"], 
+                    jupyter_port=cluster["JUPYTER_PORT"], 
+                    rstudio_port=cluster["R_PORT"],
+                    code_server_port=cluster["CODE_SERVER_PORT"],
+                ))
+            alias_lines.append("alias \"{}=bash $HOME/.ssh/{}\"".format(alias, script_name))
+        alias_text = "\n".join(alias_lines)
         
         profile = Path.home() / ".bash_profile"
         if (Path.home() / ".profile").exists() and not profile.exists():
             profile = (Path.home() / ".profile")
         elif "zsh" in os.environ["SHELL"]:
             profile = (Path.home() / ".zshrc")
-        if not profile.exists() or alias_text not in profile.read_text():
+        if not profile.exists() or \
+                not all(line in profile.read_text() for line in alias_lines):
             print("\nCopy the following text to the file ~/{}:\n".format(profile.name))
             print(alias_text)
             input("\nPress enter once you have copied over the above text")
     else:
         print("Skipping ssh config installation.")
         print("Testing ssh connection...\n")
-        if not ssh_works():
-            print("\nError connecting via 'ssh sherlock', exiting now")
-            sys.exit(1)
+        installed = read_all_installed(clusters)
         
     
-    # 5. Copy files to sherlock 
-    if yes_or_no("Copy required files to sherlock now? "):
-        print("Making directory {} on sherlock and copying files...".format(install_dir))
-        subprocess.run(["ssh", "sherlock", "mkdir", "-p", install_dir])
-        for file in ["schedule.py", "install.py", "set_jupyter_password.py", 
-                     "config.json", "notebook.template.sbatch", "rserver_auth.sh"]:
-            print("Copying {} to Sherlock".format(file))
-            cp_remote(file, install_dir + "/" + file)
-
-        # Make sure rserver_auth.sh is executable
-        subprocess.run(["ssh", "sherlock", "chmod", "u+x", install_dir + "/rserver_auth.sh"])
-
-        # Make substitutions in rsession.template.conf before upload
-        print("Fetching R_LIBS_USER from Sherlock...", end="")
-        # Use bash -l to get R_LIBS_USER even if it's only set in bash_profile
-        r_libs = get_sherlock_output(["bash", "-l", "-c", "'echo $R_LIBS_USER'"]).decode().strip()
-        if r_libs:
-           r_libs_line = "r-libs-user=" + r_libs
-        else:
-            r_libs_line = ""
-        print("found R_LIBS_USER=\"{}\"".format(r_libs))
-        rsession_conf = substitute_template(
-            open("rsession.template.conf").read(),
-            {"R_LIBS_USER": r_libs_line}
-        )
-        
-        print("Writing rsession.conf to Sherlock")
-        cp_string_remote(rsession_conf, install_dir + "/rsession.conf")
-    else:
+    # 5. Copy files and set passwords, in one ssh session per cluster
+    copy_files = yes_or_no("Copy required files to sherlock now? ")
+    if not copy_files:
         print("Skipping file copying.")
 
-    # 5. Set first password
+    password = None
     if yes_or_no("Set notebook passwords? "):
-        print("Setting notebook access password")
-        cmd_password()
+        password = new_password()
     else:
         print("Skipping password setting.")
 
-    # 6. Give instructions for setting up ssh + commands
-    print("\nAll done!")
-
+    for name, cluster in sorted(clusters.items()):
+        install_dir = cluster["INSTALL_PATH"]
+        if len(clusters) > 1:
+            print("\nCluster {}:".format(name))
+        files = {}
+        commands = []
+        if copy_files:
+            files, commands = copy_commands(cluster, installed[name], refresh)
+        if password is not None:
+            files["rstudio_password.txt"] = password.encode()
+            commands += password_commands(password)
+
+        if files or commands:
+            print("Copying files to {} on {}...".format(install_dir, cluster["HOST"]))
+            output = remote_batch(commands, files, cwd=install_dir, host=cluster["HOST"]).decode()
+            for line in output.splitlines():
+                if line.startswith("R_LIBS_USER="):
+                    print("Found R_LIBS_USER=\"{}\"".format(line[len("R_LIBS_USER="):]))
+    if password is not None:
+        print("New password is: ", password)
 
+    # 6. Give instructions for setting up ssh + commands
+    print("\nAll done! ({} ssh round trips to Sherlock)".format(ssh_round_trips))
+
+
+
+def cluster_configs(config):
+    """Settings for each cluster in config.json, by cluster name.
+
+    "CLUSTERS" in config.json maps cluster names to settings (HOST,
+    INSTALL_PATH, PARTITION, ports, etc.) that replace the top-level ones
+    for that cluster. Without it, there is a single cluster named sherlock.
+    HOST is the name to ssh to, and defaults to the cluster's name.
+    """
+    clusters = config.get("CLUSTERS") or {config.get("CLUSTER", "sherlock"): {}}
+    shared = {k: v for k, v in config.items() if k not in ["CLUSTERS", "DEFAULT_CLUSTER"]}
+    result = {}
+    for name, settings in clusters.items():
+        cluster = dict(shared)
+        cluster.update(settings)
+        cluster["CLUSTER"] = name
+        cluster.setdefault("HOST", name)
+        result[name] = cluster
+    return result
+
+def default_cluster(config):
+    """The cluster used when a command isn't given one: DEFAULT_CLUSTER if set,
+    otherwise sherlock, or the first cluster by name if there's no sherlock"""
+    clusters = sorted(cluster_configs(config))
+    if config.get("DEFAULT_CLUSTER"):
+        return config["DEFAULT_CLUSTER"]
+    return "sherlock" if "sherlock" in clusters else clusters[0]
+
+def connect_script_names(name, config):
+    """File name, alias and host cache file for a cluster's connect script"""
+    if name == default_cluster(config):
+        return "connect-nb.sh", "nb", "nb-host"
+    return "connect-nb-{}.sh".format(name), "nb-" + name, "nb-host-" + name
+
+def read_all_installed(clusters):
+    """read_installed for each cluster, exiting if any of them can't be reached"""
+    installed = {}
+    for name, cluster in sorted(clusters.items()):
+        installed[name] = read_installed(cluster["INSTALL_PATH"], cluster["HOST"])
+        if installed[name] is None:
+            print("\nError connecting via 'ssh {}', exiting now".format(cluster["HOST"]))
+            sys.exit(1)
+    return installed
+
+def copy_commands(cluster, installed, refresh):
+    """Files to copy to a cluster and commands to run after, given what's already installed"""
+    contents = {file: Path(file).read_bytes() for file in install_files}
+    # Each cluster gets a config.json with just its own settings
+    contents["config.json"] = json.dumps(
+        dict(cluster, REMOTE=True), indent=4, sort_keys=True).encode()
+    hashes = {file: hashlib.sha256(data).hexdigest() for file, data in contents.items()}
+    changed = [file for file in install_files
+               if refresh or installed["files"].get(file) != hashes[file]]
+    if refresh:
+        print("Copying all {} files".format(len(install_files)))
+    else:
+        print("{} of {} files changed since the last install".format(
+            len(changed), len(install_files)))
+    files = {file: contents[file] for file in changed}
+    commands = []
+    if "rserver_auth.sh" in changed:
+        # Make sure rserver_auth.sh is executable
+        commands.append("chmod u+x rserver_auth.sh")
+    probe_r_libs = refresh or installed["r_libs"] is None
+    if probe_r_libs:
+        # Use bash -l to get R_LIBS_USER even if it's only set in bash_profile
+        commands += [
+            "echo \"R_LIBS_USER=$(bash -l -c 'echo $R_LIBS_USER')\" > " + r_libs_file,
+            "cat " + r_libs_file,
+        ]
+    else:
+        print("Using R_LIBS_USER=\"{}\" from the last install "
+              "(run with --refresh to check again)".format(installed["r_libs"]))
+    if probe_r_libs or "rsession.template.conf" in changed:
+        commands += [
+            "R_LIBS=$(sed -n 's/^R_LIBS_USER=//p' {})".format(r_libs_file),
+            # Make substitutions in rsession.template.conf
+            "if [ -n \"$R_LIBS\" ]; then LINE=\"r-libs-user=$R_LIBS\"; else LINE=; fi",
+            "sed \"s|<R_LIBS_USER>|$LINE|\" rsession.template.conf > rsession.conf",
+        ]
+    if "notebook.template.sbatch" in changed:
+        # Jobs write their logs here, and Slurm needs it to exist before they start
+        commands.append("mkdir -p logs")
+    if changed:
+        # Written last, so a failed install is retried next time
+        files[install_manifest + ".new"] = json.dumps({"files": hashes}).encode()
+        commands.append("mv {0}.new {0}".format(install_manifest))
+    return files, commands
 
 def substitute_template(text, substitutions_dict):
     for k, v in substitutions_dict.items():
         text = text.replace("<"+k+">", v)
     return text
 
-def cp_remote(file, dest):
+def cp_remote(file, dest, host="sherlock"):
     if type(file) is str:
-        file = open(file)
-    subprocess.run(
-        ["ssh", "sherlock", "cat > '{}'".format(dest)],
-        stdin=file,
-    )
-
-def cp_string_remote(string, dest):
-    f = tempfile.TemporaryFile()
-    f.write(string.encode())
-    f.flush()
-    f.seek(0)
-    cp_remote(f, dest)
-    
-
-def cmd_password(length = 12):
+        file = open(file, "rb")
+    contents = file.read()
+    if type(contents) is str:
+        contents = contents.encode()
+    dest_dir, name = posixpath.split(dest)
+    with tracing.span("cp_remote " + name, dest=dest, bytes=len(contents)):
+        remote_batch([], {name: contents}, cwd=dest_dir, host=host)
+
+def cp_string_remote(string, dest, host="sherlock"):
+    dest_dir, name = posixpath.split(dest)
+    with tracing.span("cp_remote " + name, dest=dest, bytes=len(string)):
+        remote_batch([], {name: string.encode()}, cwd=dest_dir, host=host)
+
+def remote_batch(commands, files={}, cwd=None, host="sherlock"):
+    """Run shell commands on Sherlock (or another ssh host) using a single ssh session.
+
+    files maps file names to their contents (as bytes). They are sent as one
+    tar stream and unpacked into cwd before the commands run. Commands are
+    chained with && so the first failure stops the batch. Returns stdout.
+    """
+    global ssh_round_trips
+    script = []
+    if tracing.remote_env() is not None:
+        script.append(tracing.remote_env())
+    if cwd is not None:
+        script.append("mkdir -p {0} && cd {0}".format(shlex.quote(cwd)))
+    archive = None
+    if files:
+        script.append("tar -xf -")
+        archive = tar_archive(files)
+    script += commands
+
+    ssh_round_trips += 1
+    p = tracing.run(
+        ["ssh", host, " && ".join(script)], name="ssh " + host,
+        input=archive, stdout=subprocess.PIPE, check=True)
+    return p.stdout
+
+def tar_archive(files):
+    buffer = io.BytesIO()
+    tar = tarfile.open(fileobj=buffer, mode="w")
+    for name, contents in sorted(files.items()):
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mode = 0o644
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(contents))
+    tar.close()
+    return buffer.getvalue()
+
+def new_password(length = 12):
     chars = string.ascii_letters + string.digits
-    password = ''.join(random.choice(chars) for i in range(length))
-    install_dir = json.load(open("config.json"))["INSTALL_PATH"]
+    return ''.join(random.choice(chars) for i in range(length))
+
+def password_commands(password):
+    # Run from the installation directory, after rstudio_password.txt is written
+    return ["python3 set_jupyter_password.py " + password]
+
+def cmd_password():
+    password = new_password()
+    clusters = cluster_configs(json.load(open("config.json")))
     print("New password is: ", password)
-    print("Copying password to rstudio_password.txt on Sherlock...")
-    cp_string_remote(password, install_dir + "/rstudio_password.txt")
-    print("Setting jupyter notebook password on Sherlock...")
-    subprocess.run([
-        "ssh", "sherlock", 
-        "python3", install_dir + "/set_jupyter_password.py", password])
+    for name, cluster in sorted(clusters.items()):
+        print("Copying password to rstudio_password.txt and setting jupyter notebook "
+              "password on {}...".format(name))
+        remote_batch(
+            password_commands(password),
+            {"rstudio_password.txt": password.encode()},
+            cwd=cluster["INSTALL_PATH"], host=cluster["HOST"])
     print("Password reset.")
     print("Restart any notebooks running on Sherlock see the new password take effect")
 
-def ssh_works():
-    try:
-        output = get_sherlock_output(["echo", "Hello World"])
-        return output == b"Hello World\n"
-    except:
-        return False
+def read_installed(install_dir, host="sherlock"):
+    """Check the ssh connection, and read what the last install left on Sherlock.
 
-def get_sherlock_output(args):
-    f = tempfile.TemporaryFile()
-    p = subprocess.run(["ssh", "sherlock"] + args, stdout=f, check=True)
-    f.seek(0)
-    return f.read()
+    Returns {"files": {file: hash}, "r_libs": R_LIBS_USER or None}, or None
+    if the connection doesn't work.
+    """
+    try:
+        output = get_sherlock_output([
+            "echo", "connected;",
+            "cat", posixpath.join(install_dir, install_manifest), "2>/dev/null;",
+            "echo;",
+            "cat", posixpath.join(install_dir, r_libs_file), "2>/dev/null;",
+            "true"], host=host).decode()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    lines = output.splitlines()
+    if not lines or lines[0] != "connected":
+        return None
+    installed = {"files": {}, "r_libs": None}
+    for line in lines[1:]:
+        if line.startswith("{"):
+            try:
+                installed["files"] = json.loads(line)["files"]
+            except (ValueError, KeyError):
+                pass
+        elif line.startswith("R_LIBS_USER="):
+            installed["r_libs"] = line[len("R_LIBS_USER="):]
+    return installed
+
+
+def get_sherlock_output(args, host="sherlock"):
+    with tracing.span(tracing.describe(args), command=" ".join(args)):
+        return remote_batch([" ".join(args)], host=host)
 
     
 
@@ -266,14 +454,73 @@ Host sherlock
     ControlPath ~/.ssh/%l%r@%h:%p
 """
 
-connect_script = """\
-#!/bin/bash
-NB=$(ssh sherlock 'cat {install_dir}/current-host')
-if [ ! -z "$NB" ]; then
-    ssh -t sherlock -L {rstudio_port}:$NB:{rstudio_port} -L {jupyter_port}:$NB:{jupyter_port} -L {code_server_port}:$NB:{code_server_port} ssh $NB
-else
-    echo "Error: No running notebook job detected on Sherlock"
+connect_script = r"""#!/bin/bash
+# Connect to the running notebook job on Sherlock, forwarding the RStudio, Jupyter and
+# code-server ports. The last notebook host, job id and the ports the job's servers use
+# (which can differ from the configured ones if those were taken) are cached in
+# ~/.ssh/nb-host, so usually this takes a single ssh session, which checks that the
+# cached host is still current before connecting to it. Dropped connections are retried
+# with backoff.
+# With --wait, first wait on Sherlock until a notebook job is ready, showing its place in
+# the queue, then connect to it.
+INSTALL_DIR={install_dir}
+CACHE="$HOME/.ssh/{cache_name}"
+
+lookup_host() {{
+    ssh {host} "cat $INSTALL_DIR/current-host $INSTALL_DIR/current-job $INSTALL_DIR/current-ports 2> /dev/null" | xargs > "$CACHE"
+}}
+
+if [ "$1" = "--wait" ]; then
+    ssh {host} "python3 $INSTALL_DIR/notebook_helper.py wait-ready --dir $INSTALL_DIR" > "$CACHE.new" || exit 1
+    mv "$CACHE.new" "$CACHE"
+elif [ ! -s "$CACHE" ]; then
+    lookup_host
 fi
+DELAY=1
+TRIES=0
+while true; do
+    read -r CURRENT < "$CACHE"
+    read -r NB JOB RSTUDIO_REMOTE JUPYTER_REMOTE CODE_SERVER_REMOTE <<< "$CURRENT"
+    if [ -z "$NB" ]; then
+        rm -f "$CACHE"
+        echo "Error: No running notebook job detected on Sherlock"
+        exit 1
+    fi
+
+    # Exits 100 if the cached host is out of date, or 101 if the worker node can't be reached
+    STARTED=$(date +%s)
+    ssh -t -o ServerAliveInterval=15 -o ServerAliveCountMax=3 {host} \
+        -L {rstudio_port}:$NB:${{RSTUDIO_REMOTE:-{rstudio_port}}} \
+        -L {jupyter_port}:$NB:${{JUPYTER_REMOTE:-{jupyter_port}}} \
+        -L {code_server_port}:$NB:${{CODE_SERVER_REMOTE:-{code_server_port}}} \
+        "if [ \"\$(cat $INSTALL_DIR/current-host $INSTALL_DIR/current-job $INSTALL_DIR/current-ports 2> /dev/null | xargs)\" != \"$CURRENT\" ]; then exit 100; fi
+         ssh $NB; STATUS=\$?; if [ \$STATUS -eq 255 ]; then exit 101; fi; exit \$STATUS"
+    STATUS=$?
+
+    if [ $STATUS -eq 100 ]; then
+        lookup_host
+        continue
+    elif [ $STATUS -ne 255 ] && [ $STATUS -ne 101 ]; then
+        exit $STATUS
+    fi
+
+    # Connection dropped: retry with backoff, starting over if it had been up for a while
+    if [ $(( $(date +%s) - STARTED )) -gt 60 ]; then
+        DELAY=1
+        TRIES=0
+    fi
+    TRIES=$((TRIES + 1))
+    if [ $TRIES -gt 8 ]; then
+        echo "Error: Could not reconnect to $NB"
+        exit 1
+    fi
+    echo "Connection to $NB lost, reconnecting in $DELAY seconds..."
+    sleep $DELAY
+    DELAY=$((DELAY * 2 > 60 ? 60 : DELAY * 2))
+    if [ $STATUS -eq 101 ]; then
+        lookup_host
+    fi
+done
 """
 
 if __name__ == "__main__":
@@ -0,0 +1,678 @@
+#!/usr/bin/env python3
+
+# Helpers run from inside a notebook job on Sherlock (see notebook.template.sbatch),
+# and from nb --wait on a Sherlock login node
+# notebook_helper.py env-snapshot -- save environment changes made by module load
+# notebook_helper.py end-job -- end an earlier notebook job this one replaces
+# notebook_helper.py log -- write a size-capped log file
+# notebook_helper.py finish-logs -- compress a job's logs and delete old ones
+# notebook_helper.py ports -- pick free ports for the servers
+# notebook_helper.py ready -- wait for the servers to start listening
+# notebook_helper.py sync -- copy server state between $HOME and local disk
+# notebook_helper.py wait -- wait for the session to end, or go idle
+# notebook_helper.py wait-ready -- wait for a notebook job to be ready to connect to
+
+import calendar
+import ctypes
+import ctypes.util
+import fcntl
+import gzip
+import json
+import os
+from pathlib import Path
+import re
+import select
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+usage = """
+Usage:
+notebook_helper.py env-snapshot --before file --after file --output file
+    Compare two environments saved with `env -0`, and write a shell script
+    to --output that recreates the changes from --before to --after.
+    Job-specific variables (SLURM_*, PWD, etc.) are left out.
+
+notebook_helper.py end-job --job job_id [--timeout seconds]
+    Cancel the job and wait until it has ended (so it has copied its server
+    state back and stopped writing its session files), or until the
+    timeout (default 300s) passes.
+
+notebook_helper.py log --file path --max-mb size
+    Append everything read from stdin to --file. Once the file would grow
+    past --max-mb, it is moved to path.1 (replacing any older one) and a
+    new file is started, so the log never takes more than twice --max-mb.
+
+notebook_helper.py finish-logs --dir logs_dir --job job_id --keep count
+    Compress each of the job's logs (in logs_dir/job_id) once whatever was
+    writing it has exited, then delete the logs of all but the last
+    --keep jobs (0 to keep every job's logs).
+
+notebook_helper.py ports --ports "name:port ..."
+    Check that each configured port is free on this node, and print the
+    ports to use in the same order, replacing any that are taken (e.g. by
+    another user's job) with the next free port above it.
+
+notebook_helper.py ready --services "name:port:pid ..." [--since time]
+                         [--timeout seconds] [--status-file path]
+                         [--history-file path]
+    Probe each service's port until it accepts connections, the process
+    exits, or the timeout (default 300s) passes. Prints the names of any
+    services that didn't come up, and logs how long each one took to be
+    ready, measured from --since (a unix time, default now).
+    The results are written as JSON to --status-file, if given, and the
+    job's time to ready is appended as a JSON line to --history-file.
+
+notebook_helper.py sync --dirs "home_dir:local_dir ..." --to local|home
+                        [--interval seconds]
+    Copy each home_dir to its local_dir (--to local), or back (--to home),
+    with rsync, so the destination ends up matching. With --interval, keep
+    copying back every that many seconds until killed. Exits with status 1
+    if any copy failed.
+
+notebook_helper.py wait --hours hours [--end time] [--idle-minutes minutes]
+                        [--jupyter-port port] [--code-server-dir dir]
+                        [--extension-file path]
+    Wait until the session's time is up: --hours from now, or until --end
+    (a unix time) for jobs that were submitted early. Hours added to this job by
+    schedule.py extend, as recorded in --extension-file, count towards
+    the session's time. If --idle-minutes is given
+    (and not 0), return early once nobody has used the session for that
+    long, so the job can end and free up its allocation.
+    Activity is checked through Jupyter's REST API (kernels and
+    terminals, authenticated with $JUPYTER_TOKEN), RStudio's session
+    state files, code-server's heartbeat file, and the CPU use of the
+    job's processes.
+
+notebook_helper.py wait-ready --dir install_dir
+    Wait until a notebook job is running and its servers are ready (it
+    has written current-host in install_dir), then print its host, job
+    id and ports. While waiting, the job's state, place in the queue and
+    estimated start time are printed to stderr. Exits with status 1 if
+    there is no notebook job to wait for.
+"""
+
+# How often to check for activity, in seconds
+poll_interval = 60
+
+# CPU use (in cores, averaged over a poll interval) that counts as activity
+cpu_threshold = 0.1
+
+def main():
+    if len(sys.argv) < 2 or "-h" in sys.argv or "--help" in sys.argv:
+        print(usage)
+        sys.exit(1)
+    command = sys.argv[1]
+    opts = parse_options(sys.argv[2:])
+    if command == "env-snapshot":
+        cmd_env_snapshot(opts)
+    elif command == "end-job":
+        cmd_end_job(opts)
+    elif command == "log":
+        cmd_log(opts)
+    elif command == "finish-logs":
+        cmd_finish_logs(opts)
+    elif command == "ports":
+        cmd_ports(opts)
+    elif command == "ready":
+        cmd_ready(opts)
+    elif command == "sync":
+        cmd_sync(opts)
+    elif command == "wait":
+        cmd_wait(opts)
+    elif command == "wait-ready":
+        cmd_wait_ready(opts)
+    else:
+        print("Error: command {} not recognized".format(command))
+        print(usage)
+        sys.exit(1)
+
+def parse_options(argv):
+    if len(argv) % 2 != 0 or not all(a.startswith("--") for a in argv[::2]):
+        print("Error: expected options given as --name value")
+        print(usage)
+        sys.exit(1)
+    return {k[2:]: v for k, v in zip(argv[::2], argv[1::2])}
+
+def cmd_env_snapshot(opts):
+    before = read_env(opts["before"])
+    after = read_env(opts["after"])
+    lines = []
+    for name in sorted(set(before) | set(after)):
+        if not re.match("^[A-Za-z_][A-Za-z0-9_]*$", name) or \
+                name.startswith("SLURM_") or name in skip_env_vars:
+            continue
+        if name not in after:
+            lines.append("unset {}".format(name))
+        elif before.get(name) != after[name]:
+            lines.append("export {}={}".format(name, shlex.quote(after[name])))
+    write_atomic(opts["output"], "\n".join(lines) + "\n")
+
+# Variables that differ from job to job, or between shells
+skip_env_vars = ["PWD", "OLDPWD", "SHLVL", "_", "TMPDIR", "HOSTNAME"]
+
+def read_env(path):
+    env = {}
+    for item in open(path, "rb").read().decode(errors="replace").split("\0"):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            env[name] = value
+    return env
+
+# How far above a taken port to look for a free one
+port_search_range = 100
+
+def cmd_ports(opts):
+    specs = [spec.split(":") for spec in opts["ports"].split()]
+    configured = set(int(port) for name, port in specs)
+    chosen = []
+    for name, port in specs:
+        port = int(port)
+        # Don't take a port that another server is configured to use
+        taken = (configured - {port}) | set(chosen)
+        new_port = free_port(port, taken)
+        if new_port != port:
+            log("{} port {} is in use, using {} instead".format(name, port, new_port))
+        chosen.append(new_port)
+    print(" ".join(str(p) for p in chosen))
+
+def free_port(port, taken):
+    """port if it's free, otherwise the next free port above it not in taken"""
+    for candidate in range(port, min(port + port_search_range, 65536)):
+        if candidate not in taken and port_free(candidate):
+            return candidate
+    # Let the OS pick one
+    s = socket.socket()
+    s.bind(("", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def port_free(port):
+    s = socket.socket()
+    try:
+        s.bind(("", port))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+def cmd_ready(opts):
+    since = float(opts.get("since", time.time()))
+    timeout = float(opts.get("timeout", 300))
+    services = {}
+    for spec in opts["services"].split():
+        name, port, pid = spec.split(":")
+        services[name] = {"port": int(port), "pid": int(pid), "ready": False}
+
+    # A process may fork into the background, so only give up on a service
+    # if it has exited and still isn't listening a little while later
+    exit_grace = 10
+    start = time.time()
+    exited = {}
+    waiting = set(services)
+    while waiting and time.time() - start < timeout:
+        for name in sorted(waiting):
+            service = services[name]
+            if port_open(service["port"]):
+                service["ready"] = True
+                service["seconds"] = round(time.time() - since, 1)
+                log("{} ready on port {} after {}s".format(
+                    name, service["port"], service["seconds"]))
+                waiting.remove(name)
+            elif not process_running(service["pid"]):
+                exited.setdefault(name, time.time())
+                if time.time() - exited[name] > exit_grace:
+                    log("{} exited before it was ready".format(name))
+                    waiting.remove(name)
+        if waiting:
+            time.sleep(0.5)
+    for name in sorted(waiting):
+        log("{} not ready after {}s".format(name, timeout))
+
+    if "status-file" in opts:
+        status = {
+            "host": socket.gethostname(),
+            "job_id": os.environ.get("SLURM_JOB_ID"),
+            "job_start": since,
+            "ready": all(s["ready"] for s in services.values()),
+            "services": services,
+        }
+        write_atomic(opts["status-file"], json.dumps(status, indent=4, sort_keys=True))
+    ready_times = [s["seconds"] for s in services.values() if s["ready"]]
+    if "history-file" in opts and ready_times:
+        record = {
+            "job_id": os.environ.get("SLURM_JOB_ID"),
+            "seconds": max(ready_times),
+        }
+        with open(opts["history-file"], "a") as f:
+            print(json.dumps(record), file=f)
+    print(" ".join(name for name in sorted(services) if not services[name]["ready"]))
+
+def port_open(port):
+    try:
+        socket.create_connection(("127.0.0.1", port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+def write_atomic(path, text):
+    # Jobs on other nodes may be writing the same file, so each writes its own temporary file
+    tmp = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def log(message):
+    # stdout is reserved for command output that the job script reads
+    print(message, file=sys.stderr, flush=True)
+
+def cmd_sync(opts):
+    pairs = [spec.split(":") for spec in opts["dirs"].split()]
+    to_home = opts["to"] == "home"
+    if to_home:
+        pairs = [(local_dir, home_dir) for home_dir, local_dir in pairs]
+    if "interval" not in opts:
+        sys.exit(0 if sync_dirs(pairs, to_home) else 1)
+    # The job script stops this with SIGTERM before its final copy. Exiting stops any
+    # copy in progress too (subprocess.run kills rsync on the way out), so the two can't race
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        time.sleep(float(opts["interval"]))
+        sync_dirs(pairs, to_home)
+
+def sync_dirs(pairs, to_home):
+    """Make each destination match its source, returning whether all copies worked"""
+    ok = True
+    for source, dest in pairs:
+        if not os.path.isdir(source):
+            # No state in $HOME yet is fine, but a missing local copy must never
+            # be copied back over the one in $HOME
+            if to_home:
+                log("Not copying {} back, it no longer exists".format(source))
+                ok = False
+                continue
+            os.makedirs(source)
+        os.makedirs(dest, exist_ok=True)
+        try:
+            subprocess.run(["rsync", "-a", "--delete", source + "/", dest + "/"], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log("Couldn't copy {} to {}: {}".format(source, dest, e))
+            ok = False
+    return ok
+
+# How long finish-logs waits for a log's writer to exit, in seconds
+log_writer_timeout = 30
+
+def cmd_log(opts):
+    # Slurm signals every process in the job when it ends; keep writing until
+    # the output being logged closes, so the servers' last words are kept
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    path = opts["file"]
+    max_bytes = int(float(opts["max-mb"]) * 1024 * 1024)
+    out = open_log_for_writing(path)
+    size = out.tell()
+    while True:
+        data = os.read(sys.stdin.fileno(), 65536)
+        if not data:
+            break
+        if max_bytes > 0 and size > 0 and size + len(data) > max_bytes:
+            out.close()
+            os.replace(path, path + ".1")
+            out = open_log_for_writing(path)
+            size = 0
+        out.write(data)
+        out.flush()
+        size += len(data)
+    out.close()
+
+def open_log_for_writing(path):
+    # Opened for reading too, since locks on NFS need it. The shared lock is held
+    # until exit, so finish-logs can tell when the file is complete.
+    f = open(path, "a+b")
+    try:
+        fcntl.flock(f, fcntl.LOCK_SH)
+    except OSError:
+        pass
+    return f
+
+def cmd_finish_logs(opts):
+    job_dir = os.path.join(opts["dir"], opts["job"])
+    for name in sorted(os.listdir(job_dir)):
+        if not name.endswith(".gz"):
+            compress_log(os.path.join(job_dir, name))
+
+    keep = int(opts["keep"])
+    jobs = sorted(int(name) for name in os.listdir(opts["dir"]) if name.isdigit())
+    if keep <= 0 or len(jobs) <= keep:
+        return
+    for job in jobs[:-keep]:
+        shutil.rmtree(os.path.join(opts["dir"], str(job)), ignore_errors=True)
+        try:
+            os.remove(os.path.join(opts["dir"], "slurm-{}.out".format(job)))
+        except FileNotFoundError:
+            pass
+
+def compress_log(path):
+    f = open(path, "r+b")
+    start = time.time()
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if time.time() - start > log_writer_timeout:
+                log("{} is still being written, compressing it anyway".format(path))
+                break
+            time.sleep(0.2)
+        except OSError:
+            # No locking on this filesystem
+            break
+    # Written under another name first, so the log is never missing or half there
+    with gzip.open(path + ".gz.tmp", "wb") as out:
+        shutil.copyfileobj(f, out)
+    os.replace(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+    f.close()
+
+def cmd_wait(opts):
+    start = time.time()
+    planned_end = float(opts.get("end", 0))
+    if planned_end <= 0:
+        planned_end = start + float(opts["hours"]) * 3600
+    deadline = planned_end
+    idle_limit = float(opts.get("idle-minutes", 0)) * 60
+
+    last_active = start
+    last_cpu = job_cpu_seconds()
+    while time.time() < deadline:
+        time.sleep(min(poll_interval, max(0, deadline - time.time())))
+        extended_deadline = planned_end + extended_hours(opts) * 3600
+        if extended_deadline != deadline:
+            log("Session now ends at {}".format(time.ctime(extended_deadline)))
+            deadline = extended_deadline
+        if idle_limit <= 0:
+            continue
+        now = time.time()
+        cpu = job_cpu_seconds()
+        if (cpu - last_cpu) / poll_interval > cpu_threshold:
+            last_active = now
+        last_cpu = cpu
+        last_active = max(last_active, last_activity(opts))
+
+        if now - last_active >= idle_limit and now < deadline:
+            cpus = int(os.environ.get("SLURM_CPUS_PER_TASK", "1"))
+            hours_left = (deadline - now) / 3600
+            print("Session idle for {:.0f} minutes, ending {:.1f} hours early "
+                  "({:.1f} core-hours returned)".format(
+                      (now - last_active) / 60, hours_left, hours_left * cpus),
+                  flush=True)
+            return
+
+def extended_hours(opts):
+    """Hours added to this job by schedule.py extend"""
+    if "extension-file" not in opts:
+        return 0
+    try:
+        extension = json.load(open(opts["extension-file"]))
+    except (OSError, ValueError):
+        return 0
+    if extension.get("job_id") != os.environ.get("SLURM_JOB_ID"):
+        return 0
+    return float(extension["hours"])
+
+def last_activity(opts):
+    """Time of the most recent user activity seen in any service, or 0"""
+    times = [0]
+    if "jupyter-port" in opts:
+        times.append(jupyter_last_activity(opts["jupyter-port"]))
+    times.append(rstudio_last_activity())
+    if "code-server-dir" in opts:
+        heartbeat = Path(opts["code-server-dir"]) / "heartbeat"
+        if heartbeat.exists():
+            times.append(heartbeat.stat().st_mtime)
+    return max(times)
+
+def jupyter_last_activity(port):
+    times = [0]
+    for endpoint in ["kernels", "terminals"]:
+        request = urllib.request.Request(
+            "http://127.0.0.1:{}/api/{}".format(port, endpoint),
+            headers={"Authorization": "token " + os.environ.get("JUPYTER_TOKEN", "")})
+        try:
+            items = json.loads(urllib.request.urlopen(request, timeout=10).read().decode())
+        except (OSError, ValueError):
+            continue
+        for item in items:
+            if item.get("execution_state") == "busy":
+                times.append(time.time())
+            if item.get("last_activity"):
+                times.append(parse_utc(item["last_activity"]))
+    return max(times)
+
+def parse_utc(timestamp):
+    # e.g. 2023-07-21T17:03:18.201832Z
+    timestamp = timestamp.rstrip("Z").split(".")[0]
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%S"))
+
+def rstudio_last_activity():
+    # rsession updates its session state files as the user works
+    latest = 0
+    for sessions in [Path.home() / ".local/share/rstudio/sessions/active",
+                     Path.home() / ".rstudio/sessions/active"]:
+        if not sessions.is_dir():
+            continue
+        for root, dirs, files in os.walk(str(sessions)):
+            for f in files:
+                try:
+                    latest = max(latest, os.stat(os.path.join(root, f)).st_mtime)
+                except OSError:
+                    pass
+    return latest
+
+def job_cpu_seconds():
+    """Total CPU time used so far by this job's processes, other than this one"""
+    job_id = os.environ.get("SLURM_JOB_ID")
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            if os.stat("/proc/" + pid).st_uid != os.getuid():
+                continue
+            if job_id is not None and \
+                    "job_" + job_id not in open("/proc/{}/cgroup".format(pid)).read():
+                continue
+            # utime and stime are fields 14 and 15, counting after the command name
+            stat = open("/proc/{}/stat".format(pid)).read()
+            fields = stat[stat.rindex(")") + 2:].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+# How often wait-ready checks on the queue, and how often it checks for the job's
+# files when changes to them may not be seen by inotify, in seconds
+queue_check_interval = 30
+file_check_interval = 5
+
+# Filesystems where inotify doesn't see changes made from other nodes
+network_filesystems = ["nfs", "nfs4", "lustre", "gpfs", "beegfs", "cifs", "fuse.sshfs"]
+
+# squeue options listing this user's notebook jobs, read by parse_notebook_jobs
+# (also used by schedule.py)
+notebook_job_states = "PD,CF,R"
+notebook_job_format = "%i|%t|%P|%S|%N|%r|%L"
+
+def cmd_wait_ready(opts):
+    directory = os.path.realpath(opts["dir"])
+    watch_fd = watch_directory(directory)
+    # The job writes its files from a compute node, which only inotify on a local
+    # filesystem would notice, so otherwise check every few seconds
+    timeout = queue_check_interval
+    if watch_fd is None or on_network_filesystem(directory):
+        timeout = file_check_interval
+    last_check = 0
+    last_message = None
+    current = None
+    while True:
+        new_current = read_current(directory)
+        if new_current != current or time.time() - last_check >= queue_check_interval:
+            current = new_current
+            last_check = time.time()
+            jobs = notebook_jobs()
+            if current and jobs.get(current.split()[1], {}).get("state") == "R":
+                print(current)
+                return
+            if len(jobs) == 0:
+                log("No notebook job is running or queued")
+                sys.exit(1)
+            message = queue_message(jobs)
+            if message != last_message:
+                log(message)
+                last_message = message
+        if watch_fd is None:
+            time.sleep(timeout)
+        elif select.select([watch_fd], [], [], timeout)[0]:
+            try:
+                os.read(watch_fd, 65536)
+            except BlockingIOError:
+                pass
+
+def read_current(directory):
+    """Host, job id and ports of the ready notebook job, or None"""
+    words = []
+    for name in ["current-host", "current-job", "current-ports"]:
+        try:
+            words += open(os.path.join(directory, name)).read().split()
+        except OSError:
+            if name != "current-ports":
+                return None
+    return " ".join(words) if len(words) >= 2 else None
+
+def notebook_jobs():
+    """This user's notebook jobs, by job id"""
+    output = subprocess.run(
+        ["squeue", "-h", "-u", os.environ.get("USER", ""), "-n", "notebook",
+         "-t", notebook_job_states, "-o", notebook_job_format],
+        stdout=subprocess.PIPE).stdout.decode()
+    return parse_notebook_jobs(output)
+
+def parse_notebook_jobs(output):
+    """Jobs listed by squeue with notebook_job_format, by job id.
+
+    state is PD or R (nodes still configuring count as running). start is
+    when a running job started, or Slurm's estimate for a pending one, and
+    can be None. reason is only set for pending jobs, time_left for running ones.
+    """
+    jobs = {}
+    for line in output.splitlines():
+        fields = line.split("|")
+        if len(fields) != 7:
+            continue
+        job_id, state, partition, start, node, reason, time_left = fields
+        running = state in ["R", "CF"]
+        jobs[job_id] = {
+            "state": "R" if running else "PD",
+            "partition": partition,
+            "start": start if start not in ["N/A", ""] else None,
+            "node": node or None,
+            "reason": reason if not running else None,
+            "time_left": time_left if running else None,
+        }
+    return jobs
+
+# How often end-job checks whether the job has ended, in seconds
+end_job_interval = 5
+
+def cmd_end_job(opts):
+    job_id = opts["job"]
+    deadline = time.time() + float(opts.get("timeout", 300))
+    log("Ending notebook job {}, which this job replaces".format(job_id))
+    subprocess.run(["scancel", job_id])
+    while time.time() < deadline:
+        output = subprocess.run(["squeue", "-h", "-j", job_id, "-o", "%t"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        if not output.strip():
+            return
+        time.sleep(end_job_interval)
+    log("Job {} still hasn't ended, carrying on anyway".format(job_id))
+
+def queue_message(jobs):
+    running = [job_id for job_id, job in jobs.items() if job["state"] == "R"]
+    if running:
+        return "Job {} is running on {}, waiting for its servers to start".format(
+            running[0], jobs[running[0]]["node"])
+    # The next job to start, by squeue --start's estimate (unknown estimates go last)
+    job_id = min((job_id for job_id in jobs if jobs[job_id]["state"] == "PD"),
+                 key=lambda j: (jobs[j]["start"] is None, jobs[j]["start"] or ""),
+                 default=None)
+    if job_id is None:
+        return "Waiting for notebook jobs: {}".format(" ".join(sorted(jobs)))
+    job = jobs[job_id]
+    start = job["start"] or "unknown"
+    return "Job {} is pending in {} ({}), {} in the queue, estimated start {}".format(
+        job_id, job["partition"], job["reason"],
+        queue_position(job_id, job["partition"]), start)
+
+def queue_position(job_id, partition):
+    """Position of a pending job among the pending jobs in its partition, by priority"""
+    output = subprocess.run(
+        ["squeue", "-h", "-t", "PD", "-p", partition, "--start", "-o", "%Q|%i"],
+        stdout=subprocess.PIPE).stdout.decode()
+    priorities = []
+    for line in output.splitlines():
+        priority, other_id = line.split("|")
+        priorities.append((-float(priority), other_id))
+    ids = [other_id for _, other_id in sorted(priorities)]
+    if job_id not in ids:
+        return "?"
+    return "{} of {}".format(ids.index(job_id) + 1, len(ids))
+
+def watch_directory(path):
+    """An inotify file descriptor that becomes readable when files in path change,
+    or None if inotify isn't available"""
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    mask = 0x002 | 0x008 | 0x080 | 0x100 | 0x200
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path.encode(), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def on_network_filesystem(path):
+    mount_point, fs_type = "", ""
+    for line in open("/proc/mounts"):
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        mount = fields[1]
+        if (path == mount or path.startswith(mount.rstrip("/") + "/")) \
+                and len(mount) >= len(mount_point):
+            mount_point, fs_type = mount, fields[2]
+    return fs_type in network_filesystems
+
+if __name__ == "__main__":
+    main()
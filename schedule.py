@@ -1,31 +1,54 @@
 #!/usr/bin/env python3
 
 # Usages:
-# schedule.py reset [schedule.csv] -- set the schedule on sherlock 
+# schedule.py reset [--presubmit] [schedule.csv] -- set the schedule on sherlock 
 # schedule.py run-next -- run the next job on sherlock at scheduled time, 
-# schedule.py run-now hours cpus mem_gb -- start a notebook immediately on Sherlock.
+# schedule.py run-week -- submit every job in the coming week at once
+# schedule.py run-now [--services names] hours cpus mem_gb -- start a notebook immediately on Sherlock.
+# schedule.py extend hours -- keep the running notebook going for longer
 # schedule.py get -- print the current schedule from sherlock
+# schedule.py status -- show the notebook jobs, session and schedule on sherlock
+# schedule.py logs -- print a notebook job's logs
+# schedule.py agent --start|--stop|--stdio -- keep a connection open to sherlock
 
 # install.py install -- set installation
 # install.py password -- reset passwords
 
 import argparse
+import bisect
+import concurrent.futures
 import csv
 import datetime
+import gzip
+import hashlib
 import json
+import math
 import os
 from pathlib import Path
+import re
+import select
+import socket
+import sqlite3
 import sys
 import subprocess
+import tempfile
+import threading
 import time
 
+import history
 import install
+import notebook_helper
+import tracing
 
 if sys.version_info < (3, 5):
     print("Error: Python version 3.5 or greater is required")
     sys.exit(1)
 
 schedule_fields = ["day", "start", "hours", "cpus", "mem_gb"]
+# Columns only written out when some entry uses them
+optional_fields = ["services", "cluster", "repeat", "except"]
+# Servers a notebook job can start
+service_names = ["rstudio", "jupyter", "code-server"]
 defaults = {
     "hours": 3,
     "cpus": 1,
@@ -37,152 +60,1183 @@ Usage:
 schedule.py --help
     Show this help.
 
-schedule.py reset [schedule.csv]
+Any command can be given --trace to save how long each step took (here
+and on Sherlock) to trace.json, which can be opened in chrome://tracing.
+Setting NOTEBOOK_TRACE=file does the same.
+
+With more than one cluster in config.json, any command can be given
+--cluster name to run it on that cluster. Otherwise, get, status and
+reset run on every cluster at once, and other commands use the default
+cluster.
+
+schedule.py reset [--presubmit] [schedule.csv]
     Reset the schedule on sherlock to match schedule.csv,
-    then queue up the first job.
+    then queue up the first job. Entries that overlap or run back to
+    back are merged into a single job (see MERGE_GAP_MINUTES).
+    With --presubmit, queue up every job for the coming week instead
+    (see run-week).
     (Run on local computer or on Sherlock)
 
-schedule.py run-next 
-    Submit the next scheduled job to sbatch
-    Modifies current_schedule.csv on Sherlock.
+schedule.py run-next [--after time]
+    Submit the next scheduled job to sbatch: the first one starting
+    after --after (a unix time). Notebook jobs run this with their own
+    scheduled start when they begin. Without --after, it's the first one
+    after now and after any notebook job already pending or running. Upcoming jobs are kept in
+    schedule_index.json on Sherlock, rebuilt when the schedule changes.
     (Run on local computer or on Sherlock)
 
-schedule.py run-now hours cpus mem_gb
+schedule.py run-week
+    Submit every job in current_schedule.csv for the coming week, each
+    with its own start time. Job ids are recorded in submitted_jobs.json
+    on Sherlock, so that running this again only cancels and submits
+    the jobs that changed.
+    (Run on local computer or on Sherlock)
+
+schedule.py run-now [--services jupyter+rstudio] hours cpus mem_gb
     Submit a notebook job immediately, outside of normal scheduling.
+    --services picks which of rstudio, jupyter and code-server to start
+    (default: SERVICES in config.json, or all of them).
     (Run on local computer or on Sherlock)
     Defaults are:
         hours: {hours}h, cpus: {cpus}, mem_gb: {mem_gb}gb
 
+schedule.py extend hours
+    Keep the running notebook session going for this many more hours,
+    by raising its job's time limit with scontrol. If Slurm won't allow
+    that, submit a new session of the same size instead, which ends the
+    running one when it starts.
+    (Run on local computer or on Sherlock)
+
 schedule.py get
     Print the current schedule from sherlock.
     (Run on local computer or on Sherlock)
+
+schedule.py status [--json]
+    Show the queued and running notebook jobs (with why they are waiting
+    and when they are expected to start), the current session's node,
+    ports and servers, the last lines of each server's error log, and
+    the schedule, all fetched with a single ssh connection.
+    With --json, print the same as JSON.
+    (Run on local computer or on Sherlock)
+
+schedule.py logs [job_id] [--follow]
+    Print a notebook job's logs (the latest job's, if no job id is given),
+    kept in logs/<job id> on Sherlock. With --follow, keep printing new
+    output as it is written, until the job ends.
+    (Run on local computer or on Sherlock)
+
+schedule.py watch [--interval seconds] [--once]
+    Keep checking that the scheduled jobs are queued, and fix them if not.
+    Restarts a broken run-next chain, or after reset --presubmit,
+    resubmits missing jobs and cancels unscheduled ones.
+    Checks every 5 minutes by default, backing off to once an hour
+    while nothing needs fixing.
+    (Run on Sherlock, or on local computer)
+
+schedule.py recommend [--apply] [--weeks 8] [--min-cpus 1] [--max-cpus n]
+                       [--min-mem-gb 1] [--max-mem-gb n]
+    Suggest cpus and mem_gb for each entry in the current schedule, based
+    on what past notebook jobs starting at the same time actually used
+    (90th percentile of cores, 95th percentile of peak memory plus 25%).
+    With --apply, update current_schedule.csv on Sherlock to match.
+    (Run on local computer or on Sherlock)
+
+schedule.py stats [--weeks 8]
+    Show how long recent notebook jobs waited in the queue, how late they
+    started compared to their schedule, and how long their servers took
+    to be ready (50th, 90th and 99th percentiles), by partition and job
+    size. Job history is kept in history.sqlite on Sherlock.
+    (Run on local computer or on Sherlock)
+
+schedule.py agent --start | --stop
+    Start (or stop) a background connection to Sherlock. While it is
+    running, the other commands send their requests over it instead of
+    opening a new ssh connection each time.
+    (Run on local computer)
+
+schedule.py agent --stdio
+    Serve agent requests on stdin/stdout. Started by agent --start.
+    (Run on Sherlock)
 """.format(**defaults)
 
+# Settings used when config.json doesn't include them
+config_defaults = {
+    "IDLE_MINUTES": 0,
+    "MODULES": "gsl rstudio R/4.0.2 code-server",
+    # Fraction by which a job's cpus or memory may be reduced, if that lets it start sooner
+    "CPUS_FLEX": 0,
+    "MEM_GB_FLEX": 0,
+    # Servers started by jobs that don't list their own
+    "SERVICES": "+".join(service_names),
+    # Run each server in its own job step, with an equal share of the job's cpus and memory
+    "SERVICE_STEPS": False,
+    # Submit scheduled jobs early enough to be ready on time in this percent of past
+    # jobs (0 to submit them for the scheduled time), but never more than MAX_LEAD_MINUTES early
+    "LEAD_TIME_PERCENTILE": 0,
+    "MAX_LEAD_MINUTES": 60,
+    # Entries that overlap, or start within this many minutes of another ending, run as one job
+    "MERGE_GAP_MINUTES": 0,
+    # Keep the servers' state on the node's local disk during a job, copying it back to $HOME
+    "LOCAL_STATE": False,
+    # Size at which each of a job's logs is rotated, and how many jobs' logs to keep
+    "LOG_MAX_MB": 10,
+    "LOG_JOBS": 20,
+}
+
+# Cluster chosen with --cluster, or None for the default cluster
+selected_cluster = None
+
+# Unix socket used to reach the local agent relay, and the relay's log,
+# relative to this directory. Other clusters than the default get their own.
+agent_socket = ".agent.sock"
+agent_log = "agent.log"
+
+# Record of jobs submitted by run-week, relative to the install directory
+manifest_file = "submitted_jobs.json"
+
+# Upcoming jobs from current_schedule.csv, relative to the install directory,
+# listed this many weeks ahead (see schedule_index)
+index_file = "schedule_index.json"
+index_weeks = 8
+
+# Hours added to the running job by extend, relative to the install directory.
+# The job's notebook_helper.py wait reads it to know when the session ends.
+extension_file = "session_extension.json"
+
+# Bounds on how often watch checks the queue, in seconds
+min_watch_interval = 60
+max_watch_interval = 3600
+
+# How often watch imports finished jobs from sacct into the job history, in seconds
+history_import_interval = 6 * 3600
+
+# How far back to look in the job history when estimating lead times
+lead_time_weeks = 8
+
 def main():
+    tracing.start(sys.argv)
+    cluster = None
+    if "--cluster" in sys.argv[:-1]:
+        i = sys.argv.index("--cluster")
+        cluster = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
     command, args = parse_args(sys.argv)
 
     file_dir = str(Path(__file__).parent)
+    # Fan out before changing directory, so each cluster's command finds
+    # files given relative to where it was run from
+    if not on_sherlock() and cluster is None and command in ["get", "status", "reset"]:
+        clusters = install.cluster_configs(json.load(open(os.path.join(file_dir, "config.json"))))
+        if len(clusters) > 1:
+            fan_out(sorted(clusters), sys.argv[1:],
+                    json_output=command == "status" and args["json"])
+            return
     os.chdir(file_dir)
 
+    if not on_sherlock() and cluster is not None:
+        select_cluster(cluster)
+
     if command == "reset":
         cmd_reset(args)
     elif command == "run-next":
-        cmd_run_next()
+        cmd_run_next(args["after"])
+    elif command == "run-week":
+        cmd_run_week()
     elif command == "run-now":
         cmd_run_now(args)
     elif command == "get":
         cmd_get()
+    elif command == "status":
+        cmd_status(args)
+    elif command == "logs":
+        cmd_logs(args)
+    elif command == "watch":
+        cmd_watch(args)
+    elif command == "recommend":
+        cmd_recommend(args)
+    elif command == "stats":
+        cmd_stats(args)
+    elif command == "extend":
+        cmd_extend(args)
+    elif command == "agent":
+        cmd_agent(args)
 
-def cmd_reset(schedule):
+def cmd_reset(args):
     ## Parse schedule as a check, then copy to sherlock
-    read_schedule(open(schedule).read())
+    schedule_text = open(args["schedule"]).read()
+    entries = read_schedule(schedule_text)
+    if not on_sherlock():
+        schedule_text = cluster_schedule(entries, schedule_text)
+        entries = read_schedule(schedule_text)
+    now = datetime.datetime.today()
+    if anchor_schedule(entries, now):
+        schedule_text = schedule_to_str(entries)
+    # Show what will be merged in the coming week (it's done again on Sherlock for each week)
+    settings = dict(config_defaults, **load_config())
+    merge_occurrences(
+        schedule_occurrences(entries, now, now + datetime.timedelta(days=7)),
+        int(settings["MERGE_GAP_MINUTES"]), warn=True)
 
-    config = json.load(open("config.json"))
+    agent = connect_agent()
+    if agent is not None:
+        print("Resetting schedule on Sherlock through the agent")
+        agent.call("reset", schedule=schedule_text, presubmit=args["presubmit"])
+        return
+
+    config = load_config()
     install_dir = config["INSTALL_PATH"]
 
     print("Copying schedule to {}/current_schedule.csv on Sherlock".format(install_dir))
-    install.cp_remote(schedule, install_dir + "/current_schedule.csv")
+    write_sherlock_file(schedule_text, install_dir + "/current_schedule.csv")
 
-    # Cancel any pending jobs
-    print("Cancelling all pending notebook jobs on Sherlock")
-    pending_jobs = pending_notebook_jobids()
-    if len(pending_jobs) > 0:
-        run_sherlock(["scancel"] + pending_jobs)
+    if args["presubmit"]:
+        print("Submitting the coming week's jobs on Sherlock")
+        cmd_run_week()
+        return
+
+    cancel_pending_jobs()
 
     print("Starting schedule on Sherlock")
     cmd_run_next()
-    
 
-def cmd_run_next():    
+def cluster_schedule(entries, schedule_text):
+    """The part of a schedule that runs on the selected cluster, as text"""
+    config = json.load(open("config.json"))
+    clusters = install.cluster_configs(config)
+    for e in entries:
+        if e["cluster"] is not None and e["cluster"] not in clusters:
+            raise ValueError("Cluster \"{}\" not found in config.json".format(e["cluster"]))
+    if len(clusters) == 1 and all(e["cluster"] is None for e in entries):
+        return schedule_text
+    name = load_config()["CLUSTER"]
+    default = install.default_cluster(config)
+    return schedule_to_str([e for e in entries if (e["cluster"] or default) == name])
+
+def cancel_pending_jobs():
+    print("Cancelling all pending notebook jobs on Sherlock")
+    pending_jobs = pending_notebook_jobids()
+    if len(pending_jobs) > 0:
+        cancel_jobs(pending_jobs)
+
+def cmd_run_next(after=0):
     if not on_sherlock():
-        config = json.load(open("config.json"))
+        agent = connect_agent()
+        if agent is not None:
+            agent.call("run_next", after=after)
+            return
+        config = load_config()
         install_dir = config["INSTALL_PATH"]    
         print("Running schedule.py on Sherlock...")
         run_sherlock(
-            ["python", install_dir+"/schedule.py", "run-next"],
+            ["python", install_dir+"/schedule.py", "run-next", "--after", str(after)],
             check=True)
         sys.exit(0)
     # Guaranteed to be running on sherlock here
     
-    config = json.load(open("config.json"))
-    for k in config:
-        config[k] = str(config[k])
+    config = load_config()
     
-    ## 1. Parse schedule
-    today = datetime.datetime.today()
+    ## 1. Find the next job after this one (after is the scheduled start of the
+    ## job calling this, if any), so current_schedule.csv never needs changing
+    now = datetime.datetime.today()
+    if after > 0:
+        after = datetime.datetime.fromtimestamp(after)
+    else:
+        after = max([now] + queued_scheduled_starts())
+    next = next_scheduled(schedule_index(now), after, now)
+    if next is None:
+        # e.g. a cluster that has no entries in the schedule
+        print("No more jobs scheduled in current_schedule.csv")
+        return
+    ## 2. Fill in notebook template and submit it
+    submit_notebook(config, next, next["begin"], run_next=True, source="run-next")
+
+    # The run-next chain doesn't use the run-week manifest, so don't let it go stale
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+
+def queued_scheduled_starts():
+    """Scheduled starts of the notebook jobs already pending or running, so that
+    run-next doesn't submit the same job twice"""
+    try:
+        scheduled_starts = history.scheduled_starts()
+    except sqlite3.Error:
+        scheduled_starts = {}
+    return [datetime.datetime.fromtimestamp(scheduled_starts[job_id])
+            for job_id in notebook_jobs() if job_id in scheduled_starts]
+
+def cmd_run_week():
+    if not on_sherlock():
+        agent = connect_agent()
+        if agent is not None:
+            agent.call("run_week")
+            return
+        config = load_config()
+        install_dir = config["INSTALL_PATH"]
+        print("Running schedule.py on Sherlock...")
+        run_sherlock(
+            ["python", install_dir+"/schedule.py", "run-week"],
+            check=True)
+        sys.exit(0)
+    # Guaranteed to be running on sherlock here
+
+    config = load_config()
+    changes = reconcile_week(config, notebook_jobs(), cancel_unknown=True)
+    print("{} jobs cancelled or submitted".format(changes))
+
+def reconcile_week(config, live_jobs, cancel_unknown):
+    """Bring the submitted jobs in line with current_schedule.csv.
+
+    live_jobs is the output of notebook_jobs(). Jobs from the manifest are
+    kept while their occurrence is still scheduled and they are pending or
+    running, and missing future occurrences are submitted. Pending jobs that
+    are no longer scheduled are cancelled. If cancel_unknown is set, that
+    includes pending notebook jobs that aren't in the manifest.
+    Returns the number of jobs cancelled or submitted.
+    """
+    now = datetime.datetime.today()
+    index = schedule_index(now)
+    manifest = read_manifest()
+
+    ## 1. Keep jobs from the last run that are still scheduled and still alive.
+    submitted = {}
+    to_submit = []
+    for begin, entry in week_occurrences(index, now):
+        key = occurrence_key(begin, entry)
+        job = manifest.get(key)
+        if job is not None and job["job_id"] in live_jobs:
+            submitted[key] = job
+        elif begin > now:
+            # Occurrences that have already started are left alone, so a
+            # session that was cancelled on purpose doesn't come back
+            to_submit.append((key, begin, entry))
+
+    ## 2. Cancel other pending notebook jobs
+    kept_ids = [job["job_id"] for job in submitted.values()]
+    known_ids = [job["job_id"] for job in manifest.values()]
+    to_cancel = [
+        job_id for job_id, job in sorted(live_jobs.items())
+        if job["state"] == "PD" and job_id not in kept_ids
+            and (cancel_unknown or job_id in known_ids)
+    ]
+    if len(to_cancel) > 0:
+        print("Cancelling pending notebook jobs:", " ".join(to_cancel))
+        cancel_jobs(to_cancel)
+
+    ## 3. Submit everything else
+    for key, begin, entry in to_submit:
+        job_id = submit_notebook(config, entry, begin, run_next=False, source="run-week")
+        submitted[key] = {
+            "job_id": job_id,
+            "begin": begin.strftime("%Y-%m-%dT%H:%M"),
+            "hours": entry["hours"],
+            "cpus": entry["cpus"],
+            "mem_gb": entry["mem_gb"],
+        }
+    write_manifest(submitted)
+    return len(to_cancel) + len(to_submit)
+
+# Last line printed by watch --once on Sherlock
+watch_result = "Jobs cancelled or submitted: {}"
+
+def cmd_watch(args):
+    interval = min(max(args["interval"], min_watch_interval), max_watch_interval)
+    delay = interval
+    while True:
+        try:
+            changes = watch_once()
+        except (subprocess.CalledProcessError, OSError, RuntimeError, ValueError, KeyError,
+                sqlite3.Error) as e:
+            # e.g. Sherlock unreachable, a malformed schedule or a locked history
+            print("Error checking notebook jobs:", e)
+            changes = 0
+        # Back off while nothing needs fixing, and check again soon after a fix
+        if changes > 0:
+            delay = interval
+        else:
+            delay = min(delay * 2, max_watch_interval)
+        if args["once"]:
+            if on_sherlock():
+                # For watch_once on the local computer
+                print(watch_result.format(changes))
+            return
+        time.sleep(delay)
+
+def watch_once():
+    """Check the queued notebook jobs once, fixing any that are missing.
+
+    Returns the number of jobs cancelled or submitted.
+    """
+    if not on_sherlock():
+        agent = connect_agent()
+        if agent is not None:
+            return agent.call("watch_once")
+        config = load_config()
+        install_dir = config["INSTALL_PATH"]
+        lines = run_sherlock(
+            ["python", install_dir+"/schedule.py", "watch", "--once"],
+            stdout=subprocess.PIPE, check=True).stdout.decode().splitlines()
+        # The last line says how many jobs were cancelled or submitted
+        match = re.match(r"^Jobs cancelled or submitted: (\d+)$", lines[-1] if lines else "")
+        if match is None:
+            raise RuntimeError("unexpected output from watch on Sherlock: " + "\n".join(lines))
+        for line in lines[:-1]:
+            print(line)
+        return int(match.group(1))
+    # Guaranteed to be running on sherlock here
+
+    config = load_config()
+    try:
+        history.import_if_stale(history_import_interval)
+    except (sqlite3.Error, subprocess.CalledProcessError) as e:
+        print("Warning: couldn't update job history:", e)
+    live_jobs = notebook_jobs()
+    if read_manifest():
+        return reconcile_week(config, live_jobs, cancel_unknown=False)
+    else:
+        return repair_chain(live_jobs)
+
+def repair_chain(live_jobs):
+    """Restart the run-next chain if it has stopped. Returns 1 if restarted, else 0"""
+    now = datetime.datetime.today()
+    if next_scheduled(schedule_index(now), now, now) is None:
+        return 0
+    # Only jobs submitted for the schedule are part of the chain, not run-now jobs.
+    # Without the history, it can't be told whether the chain has stopped.
+    scheduled_starts = history.scheduled_starts()
+    chain_jobs = [job for job_id, job in live_jobs.items() if job_id in scheduled_starts]
+    if any(job["state"] == "PD" for job in chain_jobs):
+        return 0
+    # A job that just started may not have run run-next yet
+    for job in chain_jobs:
+        if job["start"] is not None and now - job["start"] < datetime.timedelta(minutes=10):
+            return 0
+    print("No pending notebook job found, restarting the schedule")
+    cmd_run_next()
+    return 1
+
+def cmd_recommend(args):
+    if not on_sherlock():
+        config = load_config()
+        install_dir = config["INSTALL_PATH"]
+        run_sherlock(
+            ["python", install_dir+"/schedule.py", "recommend"] + args["argv"],
+            check=True)
+        return
+    # Guaranteed to be running on sherlock here
+
     entries = read_schedule(open("current_schedule.csv").read())
-    next, next_time, rest = next_scheduled(entries, today)
-    ## 2. Fill in notebook template
-    config.update({
-        "HOURS": str(next["hours"]),
-        "MEM_GB": str(next["mem_gb"]),
-        "CPUS": str(next["cpus"]),
-        "BEGIN": next_time.strftime("%Y-%m-%dT%H:%M")
-    })
-    notebook_sbatch = install.substitute_template(
-        open("notebook.template.sbatch").read(),
-        config
-    )
-    open("notebook.sbatch", 'w').write(notebook_sbatch)
-    ## 3. Run sbatch command
-    print("Submitting notebook.sbatch")
-    subprocess.run(["sbatch", "notebook.sbatch"])
+    jobs = notebook_job_usage(args["weeks"])
+    print("Found {} finished notebook jobs from the last {} weeks".format(
+        len(jobs), args["weeks"]))
+
+    for entry in entries:
+        # Use jobs from the same day and start time if there are enough,
+        # otherwise the same day, otherwise all jobs
+        slot = (entry["day"], entry["start"].tm_hour, entry["start"].tm_min)
+        matching = [j for j in jobs if j["slot"] == slot]
+        source = "this slot"
+        if len(matching) < min_recommend_jobs:
+            matching = [j for j in jobs if j["slot"] is not None and j["slot"][0] == entry["day"]]
+            source = "this day"
+        if len(matching) < min_recommend_jobs:
+            matching = jobs
+            source = "all days"
+        if len(matching) < min_recommend_jobs:
+            print("{}: not enough history".format(entry_to_str(entry)))
+            continue
+
+        cpus = math.ceil(history.percentile([j["cpus_used"] for j in matching], 90))
+        mem_gb = math.ceil(history.percentile([j["mem_gb_used"] for j in matching], 95) * 1.25)
+        cpus = clamp(cpus, args["min-cpus"], args["max-cpus"])
+        mem_gb = clamp(mem_gb, args["min-mem-gb"], args["max-mem-gb"])
+        print("{}: cpus {} -> {}, mem_gb {} -> {} (from {} jobs on {})".format(
+            entry_to_str(entry), entry["cpus"], cpus, entry["mem_gb"], mem_gb,
+            len(matching), source))
+        entry["cpus"] = cpus
+        entry["mem_gb"] = mem_gb
 
-    ## 4. Remove the submitted job from the schedule
-    print("Updating current_schedule.csv")
-    write_schedule(rest, "current_schedule.csv")
+    if args["apply"]:
+        print("Updating current_schedule.csv")
+        write_schedule(entries, "current_schedule.csv")
 
+# Fewest past jobs to base a recommendation on
+min_recommend_jobs = 3
+
+def notebook_job_usage(weeks):
+    """Resource use of finished notebook jobs, from a single sacct query.
+
+    Returns a list of {"slot": (weekday, hour, minute) of the scheduled
+    start or None, "cpus_used": average cores busy, "mem_gb_used": peak memory}
+    """
+    command = [
+        "sacct",
+        "--user", "$USER",
+        "--name", "notebook",
+        "--starttime", "now-{}weeks".format(weeks),
+        "--noheader", "--parsable2",
+        "--format", "JobID,Eligible,Elapsed,TotalCPU,MaxRSS,State"]
+    # Jobs submitted early (see LEAD_TIME_PERCENTILE) became eligible before
+    # their scheduled start, so use the start saved in the history if there is one
+    try:
+        scheduled_starts = history.scheduled_starts()
+    except sqlite3.Error:
+        scheduled_starts = {}
+    jobs = {}
+    for line in get_sherlock_output(command).decode().splitlines():
+        job_id, eligible, elapsed, total_cpu, max_rss, state = line.split("|")
+        # Steps (e.g. 1234.batch) have the memory use, the job itself has the rest
+        base_id = job_id.split(".")[0]
+        job = jobs.setdefault(base_id, {"mem_gb_used": 0})
+        job["mem_gb_used"] = max(job["mem_gb_used"], history.parse_memory_gb(max_rss))
+        if "." in job_id:
+            continue
+        job["state"] = state
+        job["elapsed"] = history.parse_duration(elapsed)
+        job["total_cpu"] = history.parse_duration(total_cpu)
+        try:
+            if job_id in scheduled_starts:
+                eligible = datetime.datetime.fromtimestamp(scheduled_starts[job_id])
+            else:
+                eligible = datetime.datetime.strptime(eligible, "%Y-%m-%dT%H:%M:%S")
+            job["slot"] = (eligible.weekday(), eligible.hour, eligible.minute)
+        except ValueError:
+            job["slot"] = None
+
+    usage = []
+    for job in jobs.values():
+        if job.get("elapsed", 0) <= 0 or job["state"] in ["RUNNING", "PENDING"]:
+            continue
+        job["cpus_used"] = job["total_cpu"] / job["elapsed"]
+        usage.append(job)
+    return usage
+
+def clamp(value, low, high):
+    if low is not None:
+        value = max(value, low)
+    if high is not None:
+        value = min(value, high)
+    return value
+
+def cmd_stats(args):
+    if not on_sherlock():
+        config = load_config()
+        install_dir = config["INSTALL_PATH"]
+        run_sherlock(
+            ["python", install_dir+"/schedule.py", "stats"] + args["argv"],
+            check=True)
+        return
+    # Guaranteed to be running on sherlock here
+
+    history.import_all()
+    jobs = history.finished_jobs(time.time() - args["weeks"] * 7 * 86400)
+    print("{} notebook jobs started in the last {} weeks".format(len(jobs), args["weeks"]))
+
+    groups = {}
+    for job in jobs:
+        key = (job["partition"] or "?", job["cpus"], job["mem_gb"])
+        groups.setdefault(key, []).append(job)
+    for (partition, cpus, mem_gb), group in sorted(groups.items(), key=str):
+        print("\npartition {}, {} cpus, {}gb ({} jobs)".format(
+            partition, cpus, "?" if mem_gb is None else round(mem_gb), len(group)))
+        print_percentiles("queue wait",
+            [j["start"] - j["eligible"] for j in group if j["eligible"] is not None])
+        print_percentiles("lateness",
+            [j["start"] - j["scheduled_start"] for j in group
+             if j["scheduled_start"] is not None])
+        print_percentiles("time to ready",
+            [j["ready_seconds"] for j in group if j["ready_seconds"] is not None])
+
+def print_percentiles(name, seconds):
+    if len(seconds) == 0:
+        print("  {:14} no data".format(name + ":"))
+        return
+    print("  {:14} p50 {:>9}  p90 {:>9}  p99 {:>9}  ({} jobs)".format(
+        name + ":",
+        format_duration(history.percentile(seconds, 50)),
+        format_duration(history.percentile(seconds, 90)),
+        format_duration(history.percentile(seconds, 99)),
+        len(seconds)))
+
+def format_duration(seconds):
+    sign = "-" if seconds < 0 else ""
+    seconds = int(round(abs(seconds)))
+    return "{}{}:{:02}:{:02}".format(sign, seconds // 3600, seconds // 60 % 60, seconds % 60)
 
 def cmd_get():
     ## Just copy schedule down from sherlock
-    config = json.load(open("config.json"))
+    config = load_config()
     install_dir = config["INSTALL_PATH"]
     print("Fetching schedule from {}/current_schedule.csv on Sherlock".format(install_dir))
-    schedule = install.get_sherlock_output(
-        ["cat", install_dir + "/current_schedule.csv"]).decode().strip()
+    agent = connect_agent()
+    if agent is not None:
+        schedule = agent.call("get_schedule").strip()
+    else:
+        schedule = get_sherlock_output(
+            ["cat", install_dir + "/current_schedule.csv"]).decode().strip()
     
-    entries = read_schedule(schedule)
-    _, next_time, _ = next_scheduled(entries, datetime.datetime.today())
-    print("Next job running at:", next_time.ctime())
+    now = datetime.datetime.today()
+    settings = dict(config_defaults, **config)
+    index = build_schedule_index(read_schedule(schedule), int(settings["MERGE_GAP_MINUTES"]), now)
+    next = next_scheduled(index, now, now)
+    if next is None:
+        print("No jobs scheduled")
+    else:
+        print("Next job running at:", next["begin"].ctime())
     print(schedule)
+    week = week_occurrences(index, now)
+    if week:
+        print("\nJobs in the coming week:")
+        for _, job in week:
+            print("  " + occurrence_to_str(job))
+
+# Each job's logs are kept in logs/<job id> in the install directory (see
+# notebook.template.sbatch), and compressed when the job ends
+logs_dir = "logs"
+job_logs = ["notebook.out", "notebook.err", "rserver.err", "jupyter.err", "code-server.err"]
+
+# How often logs --follow checks for new output, in seconds
+follow_interval = 1
+
+# Error logs whose last lines status shows, from the latest job
+status_logs = ["notebook.err", "rserver.err", "jupyter.err", "code-server.err"]
+status_log_lines = 10
+
+def status_query():
+    """Shell command printing everything status shows, each part after a
+    "#status# name" line, and "#status# failed name" if its command failed"""
+    parts = [
+        ("jobs", "squeue --user $USER --name notebook --noheader --states {} "
+                 "--format '{}'".format(notebook_helper.notebook_job_states,
+                                        notebook_helper.notebook_job_format)),
+        ("current", "cat current-host current-job current-ports | xargs"),
+        ("ready", "cat current-status.json"),
+        ("schedule", "cat current_schedule.csv"),
+        ("log_job", "echo $LOG_JOB"),
+    ]
+    for name in status_logs:
+        path = "{}/$LOG_JOB/{}".format(logs_dir, name)
+        parts.append((name, "(cat {0} || gzip -dc {0}.gz) | tail -n {1}".format(
+            path, status_log_lines)))
+    commands = [
+        "cd " + load_config()["INSTALL_PATH"],
+        "LOG_JOB=$(ls {} 2> /dev/null | grep -x '[0-9]*' | sort -n | tail -n 1)".format(logs_dir),
+    ]
+    for name, command in parts:
+        commands.append("echo '#status# {0}'; {{ {1}; }} 2> /dev/null || echo '#status# failed {0}'"
+                        .format(name, command))
+    # Missing files are expected, and shouldn't fail the whole command
+    return "; ".join(commands + ["true"])
+
+def cmd_status(args):
+    agent = None if on_sherlock() else connect_agent()
+    if agent is not None:
+        output = agent.call("status")
+    else:
+        output = get_sherlock_output([status_query()]).decode()
+    status = parse_status(output)
+    if args["json"]:
+        print(json.dumps(status, indent=4, sort_keys=True))
+    else:
+        print_status(status)
+
+def parse_status(output):
+    parts = {}
+    failed = set()
+    name = None
+    for line in output.splitlines():
+        # A file without a newline at the end runs into the next marker
+        line, marker, next_name = line.partition("#status# ")
+        if name is not None and (line or not marker):
+            parts[name].append(line)
+        if marker and next_name.startswith("failed "):
+            failed.add(next_name[len("failed "):])
+            name = None
+        elif marker:
+            name = next_name
+            parts[name] = []
+
+    jobs = []
+    for job_id, job in notebook_helper.parse_notebook_jobs("\n".join(parts.get("jobs", []))).items():
+        job = dict(job, job_id=job_id)
+        job["state"] = "running" if job["state"] == "R" else "pending"
+        jobs.append(job)
+
+    current = None
+    words = " ".join(parts.get("current", [])).split()
+    if len(words) >= 2:
+        current = {"host": words[0], "job_id": words[1], "ports": None}
+        if len(words) == 5:
+            current["ports"] = dict(zip(service_names, [int(w) for w in words[2:]]))
+        # A session that was killed without cleaning up leaves its files behind
+        current["running"] = any(j["job_id"] == words[1] and j["state"] == "running"
+                                 for j in jobs)
+
+    services = None
+    try:
+        services = json.loads("\n".join(parts.get("ready", [])))["services"]
+    except (ValueError, KeyError):
+        pass
+
+    schedule = "\n".join(parts.get("schedule", []))
+    next_start = None
+    schedule_error = None
+    try:
+        if "schedule" in failed or "schedule" not in parts:
+            raise ValueError("current_schedule.csv is missing or not readable")
+        entries = read_schedule(schedule)
+        now = datetime.datetime.today()
+        settings = dict(config_defaults, **load_config())
+        next = next_scheduled(
+            build_schedule_index(entries, int(settings["MERGE_GAP_MINUTES"]), now), now, now)
+        if next is not None:
+            next_start = next["begin"].strftime("%Y-%m-%dT%H:%M:%S")
+        # Without the header, but with the same columns on every line
+        entries = schedule_to_str(entries).splitlines()[1:]
+    except ValueError as e:
+        entries = None
+        schedule_error = str(e)
+
+    return {
+        "cluster": load_config()["CLUSTER"],
+        "jobs": jobs,
+        "current": current,
+        "services": services,
+        "log_job": " ".join(parts.get("log_job", [])).strip() or None,
+        "logs": {name: parts[name] for name in status_logs if parts.get(name)},
+        "schedule": entries,
+        "schedule_error": schedule_error,
+        "next_start": next_start,
+    }
+
+def print_status(status):
+    print("Notebook jobs:")
+    if not status["jobs"]:
+        print("  none queued or running")
+    for job in status["jobs"]:
+        if job["state"] == "running":
+            print("  {}  running on {} in {}, {} left".format(
+                job["job_id"], job["node"], job["partition"], job["time_left"]))
+        else:
+            print("  {}  pending in {} ({}), expected to start {}".format(
+                job["job_id"], job["partition"], job["reason"], job["start"] or "at an unknown time"))
+
+    current = status["current"]
+    if current is None:
+        print("\nNo current session")
+    else:
+        print("\nCurrent session: job {} on {}{}".format(
+            current["job_id"], current["host"],
+            "" if current["running"] else " (no longer running)"))
+        if current["ports"] is not None:
+            print("  ports: " + ", ".join(
+                "{} {}".format(name, current["ports"][name]) for name in service_names))
+    if status["services"] is not None:
+        for name, service in sorted(status["services"].items()):
+            if service["ready"]:
+                print("  {}: ready after {}s".format(name, service["seconds"]))
+            else:
+                print("  {}: not ready".format(name))
+
+    for name in status_logs:
+        if name in status["logs"]:
+            print("\nLast lines of {} (job {}):".format(name, status["log_job"]))
+            for line in status["logs"][name]:
+                print("  " + line)
+
+    if status["schedule"] is None:
+        print("\nSchedule not shown: " + status["schedule_error"])
+    else:
+        print("\nSchedule{}".format(
+            ", next job at " + status["next_start"] if status["next_start"] else ""))
+        for line in status["schedule"]:
+            print("  " + line)
+
+def cmd_logs(args):
+    if not on_sherlock():
+        command = ["python", load_config()["INSTALL_PATH"] + "/schedule.py", "logs"]
+        if args["job_id"] is not None:
+            command.append(args["job_id"])
+        if args["follow"]:
+            command.append("--follow")
+        try:
+            p = run_sherlock(command)
+        except KeyboardInterrupt:
+            sys.exit(1)
+        sys.exit(p.returncode)
+    # Guaranteed to be running on sherlock here
+
+    job_id = args["job_id"]
+    if job_id is None:
+        jobs = [int(name) for name in os.listdir(logs_dir) if name.isdigit()] \
+            if os.path.isdir(logs_dir) else []
+        if not jobs:
+            print("No job logs found in {}/{}".format(os.getcwd(), logs_dir))
+            sys.exit(1)
+        job_id = str(max(jobs))
+    job_dir = os.path.join(logs_dir, job_id)
+    if not os.path.isdir(job_dir):
+        print("Error: no logs found for job {}".format(job_id))
+        sys.exit(1)
+
+    # Where each log has been shown up to, so each check only reads what's new
+    positions = {}
+    shown = {"name": None}
+    try:
+        show_new_logs(job_dir, positions, shown)
+        while args["follow"] and not logs_finished(job_dir):
+            time.sleep(follow_interval)
+            if output_closed():
+                return
+            show_new_logs(job_dir, positions, shown)
+        if args["follow"]:
+            # Anything written just before the logs were compressed
+            show_new_logs(job_dir, positions, shown)
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+
+def show_new_logs(job_dir, positions, shown):
+    for name in job_logs:
+        path = os.path.join(job_dir, name)
+        data = b""
+        if name not in positions:
+            # Start with any older output moved aside when the log was rotated
+            data, _ = read_log(path + ".1", None)
+        new_data, positions[name] = read_log(path, positions.get(name))
+        show_log_output(name, data + new_data, shown)
+
+def show_log_output(name, data, shown):
+    """Print output from a log, under a heading when it's from a different log than last time"""
+    if not data:
+        return
+    if shown["name"] != name:
+        sys.stdout.buffer.write("{}==> {} <==\n".format(
+            "" if shown["name"] is None else "\n", name).encode())
+        shown["name"] = name
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
+def open_log(path):
+    """Open a log for reading, whether or not it has been compressed yet.
+
+    Returns the file, its length and its inode (None once compressed, since
+    the compressed copy has the same contents under a new inode), or
+    (None, 0, None) if there is no such log.
+    """
+    try:
+        f = open(path, "rb")
+        stat = os.fstat(f.fileno())
+        return f, stat.st_size, stat.st_ino
+    except FileNotFoundError:
+        pass
+    try:
+        f = gzip.open(path + ".gz", "rb")
+    except FileNotFoundError:
+        return None, 0, None
+    # Compressed logs only need reading once, so finding the length this way is fine
+    length = f.seek(sys.maxsize)
+    return f, length, None
+
+def read_log(path, position):
+    """Output written to a log since position, and the position to continue from next time.
+
+    A position is the log's inode and the offset read up to, or None to read
+    from the start. A different inode means the log has been rotated.
+    """
+    f, length, inode = open_log(path)
+    if f is None:
+        return b"", position
+    last_inode, offset = position or (None, 0)
+    with f:
+        data = b""
+        if inode is None or last_inode is None:
+            rotated = length < offset
+        else:
+            rotated = inode != last_inode
+        if rotated:
+            # Finish the old part, then start the new one
+            old, _, old_inode = open_log(path + ".1")
+            if old is not None:
+                with old:
+                    # Rotated more than once since the last check, the rest is gone
+                    old.seek(offset if old_inode in [None, last_inode] else 0)
+                    data = old.read()
+            offset = 0
+        f.seek(offset)
+        new_data = f.read()
+    return data + new_data, (inode, offset + len(new_data))
+
+def logs_finished(job_dir):
+    """Whether the job has ended, and its logs have all been compressed"""
+    names = os.listdir(job_dir)
+    return len(names) > 0 and all(name.endswith(".gz") for name in names)
+
+def output_closed():
+    """Whether whatever is reading our output (e.g. ssh from a laptop) has gone away"""
+    poller = select.poll()
+    poller.register(sys.stdout.fileno(), select.POLLOUT)
+    return any(event & (select.POLLERR | select.POLLHUP) for _, event in poller.poll(0))
 
 def cmd_run_now(args): 
-    config = json.load(open("config.json"))
-    for k in config:
-        config[k] = str(config[k])
-    config.update({
-        "HOURS": str(args["hours"]),
-        "MEM_GB": str(args["mem_gb"]),
-        "CPUS": str(args["cpus"]),
-        "BEGIN": "now"
+    config = load_config()
+    if on_sherlock():
+        submit_notebook(config, args, "now", run_next=False, source="run-now")
+        return
+    agent = connect_agent()
+    if agent is not None:
+        print("Submitting notebook job to sbatch through the agent...")
+        agent.call("submit", entry=args)
+        return
+    # Submit from Sherlock, so the job is placed and saved to the history there
+    services = ["--services", "+".join(args["services"])] if args.get("services") else []
+    print("Submitting notebook job on Sherlock...")
+    p = run_sherlock(
+        ["python", config["INSTALL_PATH"]+"/schedule.py", "run-now"] + services +
+        [str(args["hours"]), str(args["cpus"]), str(args["mem_gb"])])
+    sys.exit(p.returncode)
+
+def cmd_extend(args):
+    config = load_config()
+    if not on_sherlock():
+        p = run_sherlock(
+            ["python", config["INSTALL_PATH"]+"/schedule.py", "extend", str(args["hours"])])
+        sys.exit(p.returncode)
+    # Guaranteed to be running on sherlock here
+
+    if not os.path.exists("current-job"):
+        print("Error: no notebook session is running")
+        sys.exit(1)
+    job_id = open("current-job").read().strip()
+    # e.g. "R 2 16G"
+    job = tracing.run(
+        ["squeue", "-h", "-j", job_id, "-o", "%t %C %m"],
+        stdout=subprocess.PIPE).stdout.decode().split()
+    if len(job) != 3 or job[0] != "R":
+        print("Error: notebook job {} is no longer running".format(job_id))
+        sys.exit(1)
+
+    p = tracing.run(
+        ["scontrol", "update", "JobId=" + job_id,
+         "TimeLimit=+{}:00:00".format(args["hours"])],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if p.returncode == 0:
+        extension = {"job_id": job_id, "hours": 0}
+        if os.path.exists(extension_file):
+            previous = json.load(open(extension_file))
+            if previous.get("job_id") == job_id:
+                extension = previous
+        extension["hours"] += args["hours"]
+        notebook_helper.write_atomic(extension_file, json.dumps(extension))
+        print("Extended notebook job {} by {}h ({}h in total)".format(
+            job_id, args["hours"], extension["hours"]))
+        return
+
+    print("Couldn't extend notebook job {}: {}".format(job_id, p.stdout.decode().strip()))
+    print("Submitting a new {}h session instead, which ends job {} when it starts".format(
+        args["hours"], job_id))
+    mem_gb = history.parse_optional(history.parse_memory_gb, job[2])
+    entry = {
+        "hours": args["hours"],
+        "cpus": int(job[1]),
+        "mem_gb": defaults["mem_gb"] if mem_gb is None else max(1, round(mem_gb)),
+    }
+    submit_notebook(config, entry, "now", run_next=False, source="extend", replaces=job_id)
+
+def fill_notebook_template(config, entry, begin, run_next, end=None, scheduled=None,
+                           replaces=None):
+    """Fill in notebook.template.sbatch for one job.
+
+    begin is either a datetime or "now". run_next controls whether the job
+    submits the next scheduled job when it starts: the first one after
+    scheduled, the job's own scheduled start. If end (a datetime) is
+    given, the session ends then rather than entry["hours"] after it starts.
+    If replaces (a job id) is given, the job ends that job when it starts.
+    """
+    substitutions = {k: str(v) for k, v in config_defaults.items()}
+    substitutions.update({k: str(v) for k, v in config.items()})
+    # Leave the servers 10 minutes to shut down
+    minutes = entry["hours"] * 60 + 10
+    if end is not None:
+        minutes = math.ceil((end - begin).total_seconds() / 60) + 10
+    if begin != "now":
+        begin = begin.strftime("%Y-%m-%dT%H:%M")
+    substitutions.update({
+        "HOURS": str(entry["hours"]),
+        "TIME_LIMIT": "{}:{:02}:00".format(minutes // 60, minutes % 60),
+        "END": "0" if end is None else str(int(time.mktime(end.timetuple()))),
+        "MEM_GB": str(entry["mem_gb"]),
+        "CPUS": str(entry["cpus"]),
+        "BEGIN": begin,
+        "RUN_NEXT": "yes" if run_next else "no",
+        "REPLACES": replaces or "",
+        "SCHEDULED": "0" if scheduled is None else str(int(timestamp(scheduled))),
+        "SERVICES": " ".join(
+            entry.get("services") or parse_services(substitutions["SERVICES"])),
+        "SERVICE_STEPS": "yes" if config_flag(config, "SERVICE_STEPS") else "no",
+        "LOCAL_STATE": "yes" if config_flag(config, "LOCAL_STATE") else "no",
     })
-    notebook_sbatch = install.substitute_template(
+    return install.substitute_template(
         open("notebook.template.sbatch").read(),
-        config
+        substitutions
     )
-    print("Writing to notebook.sbatch on Sherlock...")
-    if on_sherlock():
-        open("notebook.sbatch", 'w').write(notebook_sbatch)
-    else:
-        install.cp_string_remote(
-            notebook_sbatch, 
-            config["INSTALL_PATH"] + "/notebook.sbatch")
-    ## 3. Run sbatch command
-    print("Submitting notebook job to sbatch...")
-    run_sherlock(["sbatch", config["INSTALL_PATH"] + "/notebook.sbatch"])
-
-def next_scheduled(entries, today):
-    next = None
-    next_time = None
-    for entry in entries:
-        if next is None or scheduled_time(entry, today) < next_time:
-            next = entry
-            next_time = scheduled_time(next, today)
-    
-    rest = sorted(
-        [e for e in entries if e != next],
-        key = lambda e: scheduled_time(e, today))
-    return next, next_time, rest
+
+def submit_notebook(config, entry, begin, run_next, source, replaces=None):
+    """Submit a notebook job from Sherlock, returning its job id.
+
+    source (run-next, run-week, run-now or extend) is saved with the job's history,
+    and replaces is passed on to fill_notebook_template.
+    With LEAD_TIME_PERCENTILE set, a job for a scheduled time is submitted
+    early enough for its servers to be ready by then, and still ends on time.
+    """
+    scheduled_start = begin
+    # Merged jobs end at the last entry's end rather than after whole hours
+    end = entry.get("end")
+    lead = 0 if begin == "now" else lead_minutes(config, entry)
+    if lead > 0:
+        if end is None:
+            end = begin + datetime.timedelta(hours=entry["hours"])
+        begin = max(begin - datetime.timedelta(minutes=lead), datetime.datetime.today())
+        print("Submitting {} minutes early so the session is likely ready by {}".format(
+            lead, scheduled_start.strftime("%a %I:%M%p")))
+    notebook_sbatch = fill_notebook_template(
+        config, entry, begin, run_next, end,
+        scheduled=None if scheduled_start == "now" else scheduled_start, replaces=replaces)
+    open("notebook.sbatch", 'w').write(notebook_sbatch)
+    print("Submitting notebook.sbatch")
+    sbatch_args = placement_args(config, entry, "notebook.sbatch")
+    output = tracing.run(
+        ["sbatch", "--parsable"] + sbatch_args,
+        stdout=subprocess.PIPE, check=True).stdout.decode()
+    # --parsable prints "jobid" or "jobid;cluster"
+    job_id = output.strip().split(";")[0]
+    print("Submitted batch job", job_id)
+
+    # Placement may have changed the partition or shape from the template's
+    options = dict(a[2:].split("=", 1) for a in sbatch_args if a.startswith("--"))
+    try:
+        history.record_submission(
+            job_id, source,
+            None if begin == "now" else time.mktime(scheduled_start.timetuple()),
+            options.get("partition", config["PARTITION"]),
+            int(options.get("cpus-per-task", entry["cpus"])),
+            int(options.get("mem", str(entry["mem_gb"])).rstrip("G")),
+            entry["hours"] if "end" not in entry else
+                (entry["end"] - scheduled_start).total_seconds() / 3600)
+    except sqlite3.Error as e:
+        print("Warning: couldn't save job to history:", e)
+    return job_id
+
+def lead_minutes(config, entry):
+    """Minutes before its scheduled time to submit a job for entry, from the job history"""
+    settings = dict(config_defaults, **config)
+    q = float(settings["LEAD_TIME_PERCENTILE"])
+    if q <= 0:
+        return 0
+    try:
+        history.import_if_stale(history_import_interval)
+        lead = history.lead_time(
+            [p.strip() for p in settings["PARTITION"].split(",")],
+            entry["cpus"], entry["mem_gb"], q,
+            time.time() - lead_time_weeks * 7 * 86400)
+    except (sqlite3.Error, subprocess.CalledProcessError) as e:
+        print("Warning: couldn't estimate lead time, submitting for the scheduled time:", e)
+        return 0
+    if lead is None:
+        print("Not enough job history to estimate lead time, submitting for the scheduled time")
+        return 0
+    return min(math.ceil(lead / 60), int(settings["MAX_LEAD_MINUTES"]))
+
+def placement_args(config, entry, sbatch_path):
+    """sbatch arguments to submit the script at sbatch_path where it will start soonest.
+
+    Each partition in config["PARTITION"], and (if allowed by CPUS_FLEX and
+    MEM_GB_FLEX) smaller job shapes, is tried with sbatch --test-only at the
+    same time. The one predicted to start earliest wins, preferring the full
+    requested shape and the partition order in config.json on ties.
+    """
+    settings = dict(config_defaults, **config)
+    cpus_options = [entry["cpus"]]
+    smaller_cpus = max(1, math.floor(entry["cpus"] * (1 - float(settings["CPUS_FLEX"]))))
+    if smaller_cpus < entry["cpus"]:
+        cpus_options.append(smaller_cpus)
+    mem_options = [entry["mem_gb"]]
+    smaller_mem = max(1, math.floor(entry["mem_gb"] * (1 - float(settings["MEM_GB_FLEX"]))))
+    if smaller_mem < entry["mem_gb"]:
+        mem_options.append(smaller_mem)
+
+    candidates = []
+    for cpus in cpus_options:
+        for mem_gb in mem_options:
+            for partition in settings["PARTITION"].split(","):
+                candidates.append([
+                    "--partition=" + partition.strip(),
+                    "--cpus-per-task={}".format(cpus),
+                    "--mem={}G".format(mem_gb)])
+    if len(candidates) == 1:
+        return [sbatch_path]
+
+    with concurrent.futures.ThreadPoolExecutor(len(candidates)) as executor:
+        starts = list(executor.map(
+            lambda args: predicted_start(args, sbatch_path), candidates))
+
+    best = None
+    print("Predicted start times:")
+    for args, start in zip(candidates, starts):
+        print("  {}: {}".format(" ".join(args), start.ctime() if start else "unavailable"))
+        if start is not None and (best is None or start < best[1]):
+            best = (args, start)
+    if best is None:
+        return [sbatch_path]
+    print("Submitting with", " ".join(best[0]))
+    return best[0] + [sbatch_path]
+
+def predicted_start(args, sbatch_path):
+    # sbatch --test-only reports e.g. "sbatch: Job 1234 to start at 2023-07-21T17:03:18
+    # using 1 processors on nodes sh03-01n01 in partition wjg"
+    output = run_sherlock(
+        ["sbatch", "--test-only"] + args + [sbatch_path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode()
+    match = re.search(r"to start at (\S+)", output)
+    if match is None:
+        return None
+    try:
+        return datetime.datetime.strptime(match.group(1), "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        return None
+
+def week_occurrences(index, now):
+    """Return (start time, job) for every job in index that starts in the coming
+    week, including any still in progress, sorted by time"""
+    week_end = now + datetime.timedelta(days=7)
+    low = bisect.bisect_left(index["begins"], timestamp(now) - index["longest"] * 3600)
+    high = bisect.bisect_left(index["begins"], timestamp(week_end))
+    return [(job["begin"], job) for job in index["jobs"][low:high] if job_end(job) > now]
+
+def occurrence_key(begin, entry):
+    length = "{}h".format(entry["hours"])
+    if "end" in entry:
+        length = "until " + entry["end"].strftime("%H:%M")
+    key = "{} {} {}cpus {}gb".format(
+        begin.strftime("%Y-%m-%dT%H:%M"), length, entry["cpus"], entry["mem_gb"])
+    if entry.get("services"):
+        key += " " + "+".join(entry["services"])
+    return key
+
+def read_manifest():
+    if not os.path.exists(manifest_file):
+        return {}
+    return json.load(open(manifest_file))
+
+def write_manifest(manifest):
+    json.dump(manifest, open(manifest_file, "w"), indent=4, sort_keys=True)
+
+def next_scheduled(index, after, now):
+    """The first job in index starting after after (a datetime), skipping any that
+    have already ended by now, or None if there isn't one"""
+    i = bisect.bisect_right(index["begins"], timestamp(after))
+    for job in index["jobs"][i:]:
+        if job_end(job) > now:
+            return job
+    return None
 
 def scheduled_time(entry, today):
     time = datetime.datetime(
@@ -199,32 +1253,237 @@ def scheduled_time(entry, today):
         days_delay = 7
     
     return time + datetime.timedelta(days=days_delay)
-    
-    
+
+def timestamp(when):
+    return time.mktime(when.timetuple())
+
+def job_end(job):
+    # Merged jobs have an exact end, and hours rounded up
+    return job.get("end") or job["begin"] + datetime.timedelta(hours=job["hours"])
+
+def schedule_index(now):
+    """The jobs in current_schedule.csv over the next index_weeks weeks.
+
+    The index is cached in schedule_index.json, and only rebuilt when the
+    schedule (or MERGE_GAP_MINUTES) changes, or it no longer reaches a
+    week ahead.
+    """
+    schedule_text = open("current_schedule.csv").read()
+    settings = dict(config_defaults, **load_config())
+    gap_minutes = int(settings["MERGE_GAP_MINUTES"])
+    key = hashlib.sha256("{}\n{}".format(gap_minutes, schedule_text).encode()).hexdigest()
+    try:
+        cached = json.load(open(index_file))
+        if cached["hash"] == key and \
+                cached["until"] >= timestamp(now + datetime.timedelta(days=7)):
+            return index_from_json(cached)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = build_schedule_index(read_schedule(schedule_text), gap_minutes, now)
+    saved = index_to_json(index)
+    saved["hash"] = key
+    # Jobs starting at the same time may both rebuild it, so replace it in one step
+    notebook_helper.write_atomic(index_file, json.dumps(saved))
+    return index
+
+def build_schedule_index(entries, gap_minutes, now):
+    """Every job the schedule will run from now until index_weeks weeks from now,
+    sorted by start time, with entries that overlap merged into one job.
+
+    Jobs that started before now but are still running are included.
+    """
+    until = now + datetime.timedelta(weeks=index_weeks)
+    # Starting a week back, so a job in progress is merged the same way as when it started
+    occurrences = schedule_occurrences(entries, now - datetime.timedelta(days=7), until)
+    jobs = merge_occurrences(occurrences, gap_minutes)
+    return {
+        "jobs": jobs,
+        "begins": [timestamp(job["begin"]) for job in jobs],
+        # Merged jobs can be longer than any one entry
+        "longest": max([job["hours"] for job in jobs] or [0]),
+        "until": timestamp(until),
+    }
+
+def index_to_json(index):
+    jobs = []
+    for job in index["jobs"]:
+        job = dict(job)
+        job["begin"] = timestamp(job["begin"])
+        if "end" in job:
+            job["end"] = timestamp(job["end"])
+        jobs.append(job)
+    return {"jobs": jobs, "longest": index["longest"], "until": index["until"]}
+
+def index_from_json(saved):
+    jobs = []
+    for job in saved["jobs"]:
+        job = dict(job)
+        job["begin"] = datetime.datetime.fromtimestamp(job["begin"])
+        if "end" in job:
+            job["end"] = datetime.datetime.fromtimestamp(job["end"])
+        jobs.append(job)
+    return {
+        "jobs": jobs,
+        "begins": [timestamp(job["begin"]) for job in jobs],
+        "longest": saved["longest"],
+        "until": saved["until"],
+    }
+
+def schedule_occurrences(entries, start, end):
+    """Every occurrence of every entry that starts from start up to end, sorted by time"""
+    occurrences = []
+    for e in entries:
+        for begin in entry_occurrences(e, start, end):
+            occurrences.append({
+                "begin": begin,
+                "hours": e["hours"],
+                "cpus": e["cpus"],
+                "mem_gb": e["mem_gb"],
+                "services": e["services"],
+                "cluster": e["cluster"],
+            })
+    return sorted(occurrences, key=lambda o: o["begin"])
+
+def entry_occurrences(entry, start, end):
+    """Start times of an entry's occurrences from start up to end (datetimes)"""
+    weeks = repeat_weeks(entry)
+    if entry["date"] is None:
+        begin = scheduled_time(entry, start)
+    else:
+        begin = datetime.datetime.combine(
+            entry["date"], datetime.time(entry["start"].tm_hour, entry["start"].tm_min))
+        if weeks > 0 and begin < start:
+            # Skip ahead to the first repeat on or after start
+            step = datetime.timedelta(weeks=weeks)
+            begin += step * -((begin - start) // step)
+    occurrences = []
+    while begin < end:
+        if entry["until"] is not None and begin.date() > entry["until"]:
+            break
+        if begin >= start and not any(
+                first <= begin.date() <= last for first, last in entry["except"]):
+            occurrences.append(begin)
+        if weeks == 0:
+            break
+        begin += datetime.timedelta(weeks=weeks)
+    return occurrences
+
+def repeat_weeks(entry):
+    """Weeks between an entry's occurrences, or 0 if it only happens once.
+    Entries for a day of the week repeat every week unless they say otherwise."""
+    if entry["repeat"] is not None:
+        return entry["repeat"]
+    return 0 if entry["date"] is not None else 1
+
+def anchor_schedule(entries, now):
+    """Give a date to day-of-week entries that don't repeat every week (e.g. "once"
+    or "every 2 weeks"), from their next occurrence after now, so the schedule
+    means the same thing whenever it is read. Returns whether any entry changed."""
+    changed = False
+    for e in entries:
+        if e["date"] is None and repeat_weeks(e) != 1:
+            e["date"] = scheduled_time(e, now).date()
+            changed = True
+    return changed
+
+def merge_occurrences(occurrences, gap_minutes, warn=False):
+    """Merge occurrences (sorted by time) that overlap, or that start within
+    gap_minutes of another one ending, so that each group runs as a single job.
+
+    A merged job runs from the first start to the last end (its end, with
+    hours rounded up to whole hours), with the most cpus and memory of any
+    occurrence in it.
+    Occurrences on different clusters are never merged. With warn set,
+    merges are printed along with anything suspicious about them.
+    """
+    groups = []
+    last_group = {}
+    gap = datetime.timedelta(minutes=gap_minutes)
+    for occurrence in occurrences:
+        cluster = occurrence["cluster"] or ""
+        last = last_group.get(cluster)
+        if last is not None and occurrence["begin"] <= last["end"] + gap:
+            if warn:
+                warn_merge(last, occurrence)
+            last["end"] = max(last["end"], job_end(occurrence))
+            last["occurrences"].append(occurrence)
+        else:
+            last_group[cluster] = {
+                "begin": occurrence["begin"],
+                "end": job_end(occurrence),
+                "occurrences": [occurrence],
+            }
+            groups.append(last_group[cluster])
+
+    jobs = []
+    for group in groups:
+        first = group["occurrences"][0]
+        if len(group["occurrences"]) == 1:
+            jobs.append(first)
+            continue
+        services = [o["services"] for o in group["occurrences"]]
+        merged = {
+            "begin": group["begin"],
+            "end": group["end"],
+            "hours": math.ceil((group["end"] - group["begin"]).total_seconds() / 3600),
+            "cpus": max(o["cpus"] for o in group["occurrences"]),
+            "mem_gb": max(o["mem_gb"] for o in group["occurrences"]),
+            # No services listed means the default, which covers any others listed
+            "services": None if None in services else
+                [n for n in service_names if any(n in s for s in services)],
+            "cluster": first["cluster"],
+        }
+        if warn:
+            print("Merging {} entries into one job: {}".format(
+                len(group["occurrences"]), occurrence_to_str(merged)))
+        jobs.append(merged)
+    return jobs
+
+def warn_merge(group, occurrence):
+    """Warn about an occurrence joining group if it overlaps the group or needs
+    a different size of job"""
+    previous = group["occurrences"][-1]
+    if occurrence["begin"] < group["end"]:
+        print("Warning: {} overlaps {}".format(
+            occurrence_to_str(occurrence), occurrence_to_str(previous)))
+    if (occurrence["cpus"], occurrence["mem_gb"]) != (previous["cpus"], previous["mem_gb"]):
+        print("Warning: {} and {} ask for different cpus or mem_gb, using the larger".format(
+            occurrence_to_str(occurrence), occurrence_to_str(previous)))
+
+def occurrence_to_str(occurrence):
+    if "end" in occurrence:
+        length = "until " + occurrence["end"].strftime("%I:%M%p")
+    else:
+        length = "{}h".format(occurrence["hours"])
+    text = "{}, {}, {}, {}gb".format(
+        occurrence["begin"].strftime("%a %Y-%m-%d %I:%M%p"),
+        length, occurrence["cpus"], occurrence["mem_gb"])
+    if occurrence.get("services"):
+        text += ", " + "+".join(occurrence["services"])
+    return text
+
 class CsvDialect(csv.excel):
     skipinitialspace = True
 
 def read_schedule(schedule_text):
     lines = schedule_text.splitlines()
     body = [l for l in lines if not l.startswith("#")]
-    entries = []
-    for entry in csv.DictReader(body, dialect=CsvDialect):
-        day, start, hours, cpus, mem_gb = parse_schedule_entry(entry)
-        entries.append({
-            "day": day,
-            "start": start,
-            "hours": hours,
-            "cpus": cpus,
-            "mem_gb": mem_gb,
-        })
-    return entries
+    return [parse_schedule_entry(entry)
+            for entry in csv.DictReader(body, dialect=CsvDialect)]
 
 def parse_schedule_entry(entry):
+    date = None
     try:
         day = time.strptime(entry["day"], "%a").tm_wday
     except ValueError:
-        raise ValueError(
-            "Day \"{}\" not recognized. (Use Mon, Tue, etc.)".format(entry['day']))
+        try:
+            date = datetime.datetime.strptime(entry["day"], "%Y-%m-%d").date()
+        except ValueError:
+            raise ValueError(
+                "Day \"{}\" not recognized. (Use Mon, Tue, etc., or a date like 2024-03-18)"
+                .format(entry['day']))
+        day = date.weekday()
 
     try:
         start = time.strptime(entry["start"], "%I%p")
@@ -252,9 +1511,31 @@ def parse_schedule_entry(entry):
         mem_gb = defaults["mem_gb"]
     else:
         mem_gb = parse_mem_gb(entry["mem_gb"])
-        
 
-    return day, start, hours, cpus, mem_gb
+    # Optional column; None means the SERVICES setting in config.json
+    if (entry.get("services") or "").strip() == "":
+        services = None
+    else:
+        services = parse_services(entry["services"])
+
+    # Optional columns; by default a day of the week repeats every week, and a date happens once
+    repeat, until = parse_repeat(entry.get("repeat") or "")
+    excluded = parse_except(entry.get("except") or "")
+
+    return {
+        "day": day,
+        "date": date,
+        "start": start,
+        "hours": hours,
+        "cpus": cpus,
+        "mem_gb": mem_gb,
+        "services": services,
+        # Optional column, for config.json files with more than one cluster
+        "cluster": (entry.get("cluster") or "").strip() or None,
+        "repeat": repeat,
+        "until": until,
+        "except": excluded,
+    }
 
 def parse_hours(hours):
     try:
@@ -277,22 +1558,96 @@ def parse_mem_gb(mem_gb):
         raise ValueError(
             "Mem_gb \"{}\" not recognized. Use e.g. 8gb".format(mem_gb))
 
+def parse_services(services):
+    names = [n for n in re.split(r"[+\s]+", services.strip().lower()) if n]
+    unknown = [n for n in names if n not in service_names]
+    if len(names) == 0 or len(unknown) > 0:
+        raise ValueError(
+            "Services \"{}\" not recognized. Use e.g. jupyter+rstudio "
+            "(choices are {})".format(services, ", ".join(service_names)))
+    return [n for n in service_names if n in names]
+
+def parse_repeat(repeat):
+    """Weeks between occurrences (None if not given, 0 for once) and the date to
+    repeat until (or None), from text like "every 2 weeks until 2024-06-07" """
+    if repeat.strip() == "":
+        return None, None
+    match = re.match(r"^(once|weekly|every (\d+) weeks?)?\s*(until (\S+))?$",
+                     repeat.strip().lower())
+    if match is None or match.group(0) == "" or match.group(2) == "0":
+        raise ValueError(
+            "Repeat \"{}\" not recognized. Use e.g. once, weekly, every 2 weeks, "
+            "or weekly until 2024-06-07".format(repeat))
+    weeks = None
+    if match.group(1) == "once":
+        weeks = 0
+    elif match.group(1) == "weekly":
+        weeks = 1
+    elif match.group(2) is not None:
+        weeks = int(match.group(2))
+    until = parse_date(match.group(4)) if match.group(4) else None
+    return weeks, until
+
+def parse_except(excluded):
+    """(first, last) dates to skip, from text like "2024-05-27 2024-12-21..2025-01-05" """
+    ranges = []
+    for part in excluded.split():
+        first, _, last = part.partition("..")
+        first = parse_date(first)
+        last = parse_date(last) if last else first
+        if last < first:
+            raise ValueError("Except dates \"{}\" end before they start".format(part))
+        ranges.append((first, last))
+    return ranges
+
+def parse_date(date):
+    try:
+        return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(
+            "Date \"{}\" not recognized. Use e.g. 2024-03-18".format(date))
+
 def write_schedule(entries, path):
-    f = open(path, "w")
-    print(", ".join(schedule_fields), file=f)
-    for e in entries:
-        print(entry_to_str(e), file=f)
+    open(path, "w").write(schedule_to_str(entries))
+
+def schedule_to_str(entries):
+    extra = [f for f in optional_fields if any(optional_value(e, f) for e in entries)]
+    lines = [", ".join(schedule_fields + extra)] + [entry_to_str(e, extra) for e in entries]
+    return "\n".join(lines) + "\n"
 
-def entry_to_str(entry):
+def entry_to_str(entry, extra=None):
+    """One schedule line for entry, followed by the optional columns in extra
+    (default: the ones entry has set)"""
     days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
     start = time.strftime("%I:%M%p", entry["start"])
-    return "{}, {}, {}h, {}, {}gb".format(
-               days[entry['day']],
+    text = "{}, {}, {}h, {}, {}gb".format(
+               entry["date"].isoformat() if entry.get("date") else days[entry['day']],
                start,
                entry['hours'],
                entry['cpus'],
                entry['mem_gb']
            )
+    if extra is None:
+        extra = [f for f in optional_fields if optional_value(entry, f)]
+    for field in extra:
+        text += ", " + optional_value(entry, field)
+    return text.rstrip(", ")
+
+def optional_value(entry, field):
+    """Text for one of an entry's optional columns, or "" if it isn't set"""
+    value = entry.get(field)
+    if field == "services" and value:
+        return "+".join(value)
+    if field == "repeat":
+        words = {None: "", 0: "once", 1: "weekly"}.get(value, "every {} weeks".format(value))
+        if entry.get("until") is not None:
+            words += " until " + entry["until"].isoformat()
+        return words.strip()
+    if field == "except" and value:
+        return " ".join(
+            first.isoformat() if first == last else "{}..{}".format(first, last)
+            for first, last in value)
+    return value or ""
 
 def parse_args(argv):
     if len(argv) < 2:
@@ -304,21 +1659,34 @@ def parse_args(argv):
     command = argv[1]
     args = None
 
-    if command not in ["reset", "run-now", "run-next", "get"]:
+    if command not in ["reset", "run-now", "run-next", "run-week", "get", "status", "logs",
+                       "watch", "recommend", "stats", "extend", "agent"]:
         print("Error: command {} not recognized".format(command))
         print(usage)
         sys.exit(1)
 
     if command == "reset":
+        presubmit = "--presubmit" in argv
+        argv = [a for a in argv if a != "--presubmit"]
         if not len(argv) == 3:
             print("Error: reset must have exactly one schedule given")
             print(usage)
             sys.exit(1)
         else:
-            args = str(Path(argv[2]).absolute())
+            args = {
+                "schedule": str(Path(argv[2]).absolute()),
+                "presubmit": presubmit
+            }
 
     if command == "run-now":
         args = {**defaults}
+        if "--services" in argv:
+            i = argv.index("--services")
+            if i + 1 >= len(argv):
+                print("Error: --services needs a value, e.g. jupyter+rstudio")
+                sys.exit(1)
+            args["services"] = parse_services(argv[i + 1])
+            argv = argv[:i] + argv[i + 2:]
         if len(argv) >= 3:
             args["hours"] = parse_hours(argv[2])
         if len(argv) >= 4:
@@ -330,15 +1698,111 @@ def parse_args(argv):
             print(usage)
             sys.exit(1)
     
-    if command in ["run-next", "get"]:
+    if command == "extend":
+        if len(argv) != 3:
+            print("Error: extend must be given the number of hours to add")
+            print(usage)
+            sys.exit(1)
+        args = {"hours": parse_hours(argv[2])}
+
+    if command == "run-next":
+        args = parse_options(command, argv[2:], {"after": 0})
+
+    if command in ["run-week", "get"]:
         if len(argv) != 2:
             print("Error: {} must have zero arguments given".format(command))
             print(usage)
             sys.exit(1)
+
+    if command == "watch":
+        args = parse_options(command, argv[2:], {"interval": 300, "once": False})
+
+    if command == "status":
+        args = parse_options(command, argv[2:], {"json": False})
+
+    if command == "logs":
+        job_ids = [a for a in argv[2:] if not a.startswith("--")]
+        if len(job_ids) > 1 or not all(job_id.isdigit() for job_id in job_ids):
+            print("Error: logs can be given one job id")
+            print(usage)
+            sys.exit(1)
+        args = parse_options(command, [a for a in argv[2:] if a.startswith("--")],
+                             {"follow": False})
+        args["job_id"] = job_ids[0] if job_ids else None
+
+    if command == "stats":
+        args = parse_options(command, argv[2:], {"weeks": 8})
+        args["argv"] = argv[2:]
+
+    if command == "recommend":
+        args = parse_options(command, argv[2:], {
+            "apply": False,
+            "weeks": 8,
+            "min-cpus": 1,
+            "max-cpus": None,
+            "min-mem-gb": 1,
+            "max-mem-gb": None,
+        })
+        # Kept so the same options can be passed on to Sherlock
+        args["argv"] = argv[2:]
+
+    if command == "agent":
+        modes = ["--start", "--stop", "--stdio", "--relay"]
+        if len(argv) != 3 or argv[2] not in modes:
+            print("Error: agent must be given one of --start, --stop or --stdio")
+            print(usage)
+            sys.exit(1)
+        args = argv[2]
     
     return command, args
+
+def parse_options(command, argv, defaults):
+    """Parse --name value options, or --name flags for options defaulting to False.
+
+    defaults gives the allowed option names (without --) and their defaults.
+    Options given must be numbers unless they are flags.
+    """
+    options = dict(defaults)
+    while argv:
+        name = argv[0][2:]
+        if not argv[0].startswith("--") or name not in options:
+            print("Error: {} argument {} not recognized".format(command, argv[0]))
+            print(usage)
+            sys.exit(1)
+        if defaults[name] is False:
+            options[name] = True
+            argv = argv[1:]
+            continue
+        try:
+            options[name] = int(argv[1])
+        except (IndexError, ValueError):
+            print("Error: {} must be given a whole number".format(argv[0]))
+            sys.exit(1)
+        argv = argv[2:]
+    return options
         
+def notebook_jobs():
+    """Return {job id: {"state": "PD" or "R", "start": datetime or None}} for queued notebook jobs"""
+    command = [
+        "squeue",
+        "--user", "$USER",
+        "--name", "notebook",
+        "--noheader",
+        "--format", "'{}'".format(notebook_helper.notebook_job_format),
+        "--states", notebook_helper.notebook_job_states]
+    jobs = notebook_helper.parse_notebook_jobs(get_sherlock_output(command).decode())
+    for job_id, job in jobs.items():
+        start = None
+        if job["state"] == "R" and job["start"] is not None:
+            start = datetime.datetime.strptime(job["start"], "%Y-%m-%dT%H:%M:%S")
+        jobs[job_id] = {"state": job["state"], "start": start}
+    return jobs
+
 def pending_notebook_jobids():
+    if not on_sherlock():
+        agent = connect_agent()
+        if agent is not None:
+            return agent.call("squeue")
     command = [
         "squeue", 
         "--user", "$USER", 
@@ -346,16 +1810,337 @@ def pending_notebook_jobids():
         "--noheader",
         "--format" ,"%i",
         "--states", "PD"]
-    return install.get_sherlock_output(command).decode().splitlines()
+    return get_sherlock_output(command).decode().splitlines()
+
+def cancel_jobs(job_ids):
+    if not on_sherlock():
+        agent = connect_agent()
+        if agent is not None:
+            agent.call("scancel", job_ids=job_ids)
+            return
+    run_sherlock(["scancel"] + job_ids)
+
+def write_sherlock_file(text, path):
+    if on_sherlock():
+        open(path, "w").write(text)
+        return
+    agent = connect_agent()
+    if agent is not None:
+        agent.call("write_file", path=path, contents=text)
+    else:
+        install.cp_string_remote(text, path, host=ssh_host())
 
 
 def on_sherlock():
-    return "SHERLOCK" in os.environ
+    return install.on_sherlock()
+
+def load_config():
+    """Settings from config.json for the selected cluster (see select_cluster)"""
+    config = json.load(open("config.json"))
+    clusters = install.cluster_configs(config)
+    return clusters[selected_cluster or install.default_cluster(config)]
+
+def config_flag(config, name):
+    """An on/off setting from config.json: true or false, or "yes" or "no" """
+    value = dict(config_defaults, **config)[name]
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ["yes", "true"]:
+        return True
+    if str(value).strip().lower() in ["no", "false"]:
+        return False
+    print("Error: {} in config.json must be true or false, not {}".format(
+        name, json.dumps(value)))
+    sys.exit(1)
+
+def select_cluster(name):
+    """Make the rest of this command run on the cluster called name"""
+    global selected_cluster, agent_socket, agent_log
+    config = json.load(open("config.json"))
+    clusters = install.cluster_configs(config)
+    if name not in clusters:
+        print("Error: cluster {} not found in config.json (choices are {})".format(
+            name, ", ".join(sorted(clusters))))
+        sys.exit(1)
+    selected_cluster = name
+    if name != install.default_cluster(config):
+        agent_socket = ".agent-{}.sock".format(name)
+        agent_log = "agent-{}.log".format(name)
+
+def fan_out(clusters, argv, json_output=False):
+    """Run this command (given by argv) on every cluster at once.
+
+    Each cluster's output is printed once it finishes, in order. With
+    json_output, each cluster prints JSON, and they are combined into one
+    object by cluster name.
+    """
+    env = dict(os.environ)
+    if tracing.active:
+        env[tracing.trace_env] = "-"
+    def run(name):
+        return tracing.run(
+            [sys.executable, str(Path(__file__).absolute()), "--cluster", name] + argv,
+            name="cluster " + name,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    failed = []
+    combined = {}
+    with concurrent.futures.ThreadPoolExecutor(len(clusters)) as pool:
+        for name, p in zip(clusters, pool.map(run, clusters)):
+            if p.returncode != 0:
+                failed.append(name)
+            if json_output and p.returncode == 0:
+                combined[name] = json.loads(p.stdout.decode())
+                continue
+            print("==== {} ====".format(name))
+            print(p.stdout.decode(), end="", flush=True)
+    if json_output:
+        print(json.dumps(combined, indent=4, sort_keys=True))
+    if failed:
+        print("Error: failed on", ", ".join(failed))
+        sys.exit(1)
+
+def ssh_host():
+    return load_config()["HOST"]
 
 def run_sherlock(args, **kwargs):
+    name = tracing.describe(args)
     if not on_sherlock():
-        args = ["ssh", "sherlock"] + args 
-    return subprocess.run(args, **kwargs)
+        host = ssh_host()
+        name = "ssh {} {}".format(host, name)
+        if tracing.remote_env() is not None:
+            args = [tracing.remote_env(), "&&"] + args
+        args = ["ssh", host] + args 
+    return tracing.run(args, name=name, **kwargs)
+
+def get_sherlock_output(args):
+    if on_sherlock():
+        # Run through the shell so variables like $USER expand as they would over ssh
+        return tracing.run(
+            " ".join(args), shell=True, stdout=subprocess.PIPE, check=True).stdout
+    return install.get_sherlock_output(args, host=ssh_host())
+
+## Agent: a long-lived schedule.py on Sherlock that serves requests over
+## one ssh connection. Locally, a background relay owns that connection and
+## accepts requests from other schedule.py commands over a unix socket.
+
+def cmd_agent(mode):
+    if mode == "--stdio":
+        serve_agent()
+    elif mode == "--start":
+        start_agent()
+    elif mode == "--stop":
+        agent = connect_agent()
+        if agent is None:
+            print("No agent is running")
+            return
+        agent.call("shutdown")
+        print("Agent stopped")
+    elif mode == "--relay":
+        run_agent_relay()
+
+def serve_agent():
+    # Keep the real stdout for responses. Anything else printed while handling
+    # a request (including output of sbatch and friends) is captured and sent
+    # back in the response, and stray output outside a request goes to stderr.
+    responses = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+    for line in sys.stdin:
+        request = json.loads(line)
+        response = {"id": request.get("id")}
+        if request.get("trace"):
+            tracing.capture()
+        with tempfile.TemporaryFile() as captured:
+            os.dup2(captured.fileno(), 1)
+            try:
+                if request.get("op") not in agent_ops:
+                    raise ValueError(
+                        "Agent request \"{}\" not recognized".format(request.get("op")))
+                response["result"] = agent_ops[request["op"]](request)
+            except (Exception, SystemExit) as e:
+                response["error"] = str(e) or type(e).__name__
+            finally:
+                sys.stdout.flush()
+                os.dup2(2, 1)
+            captured.seek(0)
+            response["output"] = captured.read().decode(errors="replace")
+        if request.get("trace"):
+            response["spans"] = tracing.end_capture()
+        print(json.dumps(response), file=responses, flush=True)
+
+def agent_get_schedule(request):
+    return open("current_schedule.csv").read()
+
+def agent_reset(request):
+    read_schedule(request["schedule"])
+    write_sherlock_file(request["schedule"], "current_schedule.csv")
+    if request.get("presubmit"):
+        cmd_run_week()
+        return
+    cancel_pending_jobs()
+    cmd_run_next()
+
+def agent_run_next(request):
+    cmd_run_next(request.get("after", 0))
+
+def agent_run_week(request):
+    cmd_run_week()
+
+def agent_watch_once(request):
+    return watch_once()
+
+def agent_submit(request):
+    config = load_config()
+    submit_notebook(config, request["entry"], "now", run_next=False, source="run-now")
+
+def agent_status(request):
+    return get_sherlock_output([status_query()]).decode()
+
+def agent_squeue(request):
+    return pending_notebook_jobids()
+
+def agent_scancel(request):
+    cancel_jobs(request["job_ids"])
+
+def agent_write_file(request):
+    write_sherlock_file(request["contents"], request["path"])
+
+agent_ops = {
+    "ping": lambda request: "pong",
+    "get_schedule": agent_get_schedule,
+    "reset": agent_reset,
+    "run_next": agent_run_next,
+    "run_week": agent_run_week,
+    "watch_once": agent_watch_once,
+    "submit": agent_submit,
+    "status": agent_status,
+    "squeue": agent_squeue,
+    "scancel": agent_scancel,
+    "write_file": agent_write_file,
+}
+
+class AgentClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rwb")
+
+    def call(self, op, **params):
+        params["op"] = op
+        if tracing.active:
+            params["trace"] = True
+        with tracing.span("agent " + op):
+            self.file.write((json.dumps(params) + "\n").encode())
+            self.file.flush()
+            line = self.file.readline()
+        if not line:
+            if op == "shutdown":
+                return None
+            raise RuntimeError("Lost connection to the agent")
+        response = json.loads(line.decode())
+        tracing.merge_events(response.get("spans", []))
+        print(response.get("output", ""), end="")
+        if "error" in response:
+            raise RuntimeError("Agent error: " + response["error"])
+        return response.get("result")
+
+_agent = None
+
+def connect_agent():
+    """Return a client for the local agent relay, or None if it isn't running"""
+    global _agent
+    if _agent is not None:
+        return _agent
+    if on_sherlock() or not hasattr(socket, "AF_UNIX") \
+            or not os.path.exists(agent_socket):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(agent_socket)
+    except ConnectionRefusedError:
+        # Relay exited without cleaning up
+        os.remove(agent_socket)
+        return None
+    _agent = AgentClient(sock)
+    return _agent
+
+def start_agent():
+    if not hasattr(socket, "AF_UNIX"):
+        print("Error: the agent needs unix socket support")
+        sys.exit(1)
+    if connect_agent() is not None:
+        print("Agent is already running")
+        return
+    # Connect once in the foreground so any login prompts happen here, and
+    # the relay below can reuse the ControlMaster connection.
+    print("Connecting to Sherlock...")
+    install.get_sherlock_output(["true"], host=ssh_host())
+    cluster_args = [] if selected_cluster is None else ["--cluster", selected_cluster]
+    subprocess.Popen(
+        [sys.executable, str(Path(__file__).absolute())] + cluster_args + ["agent", "--relay"],
+        stdin=subprocess.DEVNULL,
+        stdout=open(agent_log, "w"),
+        stderr=subprocess.STDOUT,
+        start_new_session=True)
+    for i in range(300):
+        if os.path.exists(agent_socket):
+            connect_agent().call("ping")
+            print("Agent started")
+            return
+        time.sleep(0.1)
+    print("Error: agent failed to start, see", agent_log)
+    sys.exit(1)
+
+def run_agent_relay():
+    config = load_config()
+    ssh = subprocess.Popen(
+        ["ssh", config["HOST"], "python3", config["INSTALL_PATH"] + "/schedule.py",
+         "agent", "--stdio"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(agent_socket)
+    server.listen(8)
+
+    # Requests from all clients share the one ssh connection, so give each
+    # request a fresh id and route the response back by that id.
+    clients = {}
+    request_ids = iter(range(1, sys.maxsize))
+    lock = threading.Lock()
+
+    def shutdown():
+        if os.path.exists(agent_socket):
+            os.remove(agent_socket)
+        os._exit(0)
+
+    def read_responses():
+        for line in ssh.stdout:
+            response = json.loads(line.decode())
+            with lock:
+                conn = clients.pop(response["id"], None)
+            if conn is not None:
+                try:
+                    conn.sendall(line)
+                except OSError:
+                    pass
+        print("Connection to Sherlock closed")
+        shutdown()
+
+    def serve_client(conn):
+        for line in conn.makefile("rb"):
+            request = json.loads(line.decode())
+            if request["op"] == "shutdown":
+                ssh.stdin.close()
+                ssh.wait()
+                shutdown()
+            with lock:
+                request["id"] = next(request_ids)
+                clients[request["id"]] = conn
+                ssh.stdin.write((json.dumps(request) + "\n").encode())
+                ssh.stdin.flush()
+        conn.close()
+
+    threading.Thread(target=read_responses, daemon=True).start()
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve_client, args=(conn,), daemon=True).start()
 
 if __name__ == "__main__":
   main()
\ No newline at end of file
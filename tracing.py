@@ -0,0 +1,150 @@
+# Timed spans for schedule.py and install.py commands, saved as a Chrome
+# trace (open it in chrome://tracing or https://ui.perfetto.dev).
+#
+# Tracing is on when NOTEBOOK_TRACE is set to a file name, or when a command
+# is given --trace (which writes trace.json). Commands run on Sherlock for a
+# traced command get NOTEBOOK_TRACE=-, which prints their spans to stderr on
+# exit, marked so the local side can pick them out and merge them in.
+
+import atexit
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+trace_env = "NOTEBOOK_TRACE"
+default_trace_file = "trace.json"
+remote_marker = b"#notebook-trace# "
+
+events = []
+active = False
+_lock = threading.Lock()
+
+def start(argv):
+    """Turn on tracing if --trace is in argv (and remove it) or NOTEBOOK_TRACE is set"""
+    global active
+    if "--trace" in argv:
+        argv.remove("--trace")
+        os.environ.setdefault(trace_env, default_trace_file)
+    path = os.environ.get(trace_env)
+    if not path:
+        return
+    if path != "-":
+        # Resolve now, since main() changes directory
+        path = os.path.abspath(path)
+    active = True
+    name = " ".join([os.path.basename(argv[0])] + argv[1:2])
+    add_event({"name": "process_name", "ph": "M", "pid": os.getpid(),
+               "args": {"name": "{} ({})".format(name, socket.gethostname())}})
+    atexit.register(finish, path, name, time.time())
+
+def finish(path, name, start_time):
+    add_span(name, start_time, time.time(), {"argv": " ".join(sys.argv)})
+    if path == "-":
+        sys.stdout.flush()
+        sys.stderr.buffer.write(remote_marker + json.dumps(events).encode() + b"\n")
+        sys.stderr.flush()
+        return
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print("Wrote trace to", path, file=sys.stderr)
+
+def add_event(event):
+    with _lock:
+        events.append(event)
+
+def add_span(name, start_time, end_time, args):
+    add_event({
+        "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+        "ts": int(start_time * 1e6), "dur": int((end_time - start_time) * 1e6),
+        "args": args,
+    })
+
+class span:
+    """Context manager recording a span named name, with args as details"""
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+    def __enter__(self):
+        self.start = time.time()
+        return self
+    def __exit__(self, *exc_info):
+        if active:
+            add_span(self.name, self.start, time.time(), self.args)
+
+def describe(args):
+    """Short span name for a command, e.g. "schedule.py run-next" or "sbatch --test-only" """
+    if type(args) is str:
+        args = args.split()
+    args = [os.path.basename(a) for a in args if not a.startswith("python")]
+    # Keep the second word if it's a subcommand or a flag, not an option's value
+    if len(args) >= 3 and args[1].startswith("-") and not args[2].startswith("-"):
+        return args[0]
+    return " ".join(args[:2])
+
+def remote_env():
+    """Shell command that turns on tracing for a command run on Sherlock, or None"""
+    if not active:
+        return None
+    return "export {}=-".format(trace_env)
+
+def run(args, name=None, **kwargs):
+    """subprocess.run in a span (named name, or after the command), merging in
+    spans printed by remote commands"""
+    if not active:
+        return subprocess.run(args, **kwargs)
+    check = kwargs.pop("check", False)
+    stderr = kwargs.pop("stderr", None)
+    name = name or describe(args)
+    with span(name, command=args if type(args) is str else " ".join(args)):
+        p = subprocess.run(args, stderr=subprocess.PIPE if stderr is None else stderr,
+                           **kwargs)
+    p.stdout = merge_remote_spans(p.stdout)
+    p.stderr = merge_remote_spans(p.stderr)
+    if stderr is None:
+        sys.stderr.buffer.write(p.stderr)
+        sys.stderr.flush()
+        p.stderr = None
+    if check and p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args, p.stdout, p.stderr)
+    return p
+
+def merge_remote_spans(output):
+    """Take the remote spans out of output (bytes or None), adding them to the trace"""
+    if not output:
+        return output
+    kept = []
+    for line in output.splitlines(True):
+        if line.startswith(remote_marker):
+            try:
+                merge_events(json.loads(line[len(remote_marker):].decode()))
+                continue
+            except ValueError:
+                pass
+        kept.append(line)
+    return b"".join(kept)
+
+def merge_events(new_events):
+    with _lock:
+        events.extend(new_events)
+
+def capture():
+    """Start recording spans for one agent request"""
+    global active
+    with _lock:
+        del events[:]
+    add_event({"name": "process_name", "ph": "M", "pid": os.getpid(),
+               "args": {"name": "schedule.py agent ({})".format(socket.gethostname())}})
+    active = True
+
+def end_capture():
+    """Stop recording, returning the spans recorded since capture()"""
+    global active
+    active = False
+    with _lock:
+        captured = list(events)
+        del events[:]
+    return captured